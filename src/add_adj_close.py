@@ -1,20 +1,36 @@
 
+import hashlib
+import io
+import os
 import re
+import threading
 import dill
-import jpbizday
 from jpbizday.jpbizday import bizdays
 import pandas as pd
 import numpy as np
 from bs4 import BeautifulSoup
-from typing import List, Union
+try:
+    import lxml.html
+except ImportError:  # lxml が無ければ BeautifulSoup の html.parser でパースする
+    lxml = None
+from typing import Dict, List, Tuple, Union
 from datetime import datetime, timezone, timedelta
 import argparse
+import glob
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from adj_rate_index import AdjRateIndex
+from adj_factors import AdjFactors
+
+AdjRates = Union[pd.DataFrame, AdjRateIndex]  # 終値調整比のDFか、それに索引を付けたもの
 
 class AddAdjClose:
     JST: timezone = timezone(timedelta(hours=+9), 'JST')
+    # path -> (mtime, 終値調整比のDF, その索引)
+    _adj_rates_cache: Dict[str, Tuple[float, pd.DataFrame, AdjRateIndex]] = {}
+    _adj_rates_cache_lock: threading.Lock = threading.Lock()
 
     @classmethod
-    def get_adj_rate(cls, paths_to_html: List[str]) -> pd.DataFrame:
+    def get_adj_rate(cls, paths_to_html: List[str], cache_dir: str=None) -> pd.DataFrame:
         '''
         与えたHTMLファイルから、終値調整比を作成して、DFで返す。
         得られる適用日の次営業日から、調整比が有効になるので、その点注意。
@@ -23,46 +39,67 @@ class AddAdjClose:
         ---------------------
         path_to_html: List[str]
             相対パスor絶対パス
+        cache_dir: str
+            与えたら、HTMLから取り出した表を、HTMLの内容のハッシュ毎にCSVで保存しておき、
+            次回以降、同じ内容のHTMLはパースしない
 
         Returns
         ---------------------
         dataframe: pd.DataFrame
         '''
 
-        def _convert_to_ratio(nl: str) -> float: 
-            before, after = re.split('[→：]', nl.replace('株', ''))
-            return float(after) / float(before)
+        def _convert_to_ratio(nl: pd.Series) -> pd.Series:
+            # e.g. '10株→1株' -> 0.1
+            before_after = nl.str.replace('株', '', regex=False) \
+                .str.split('[→：]', regex=True, expand=True).astype(np.float64)
+            return before_after[1] / before_after[0]
+
+        def _table_rows(html: str) -> List[List[str]]:
+            if lxml is None:
+                soup = BeautifulSoup(html, 'html.parser')
+                table = soup.find('table', {'class': 'tbl01'})
+                return [
+                    [cell.get_text() for cell in row.findAll(['td', 'th'])]
+                    for row in table.findAll('tr')
+                ]
+            table = lxml.html.document_fromstring(html).xpath(
+                '//table[contains(concat(" ", normalize-space(@class), " "), " tbl01 ")]')[0]
+            return [
+                [cell.text_content() for cell in row.xpath('.//td|.//th')]
+                for row in table.xpath('.//tr')
+            ]
 
         def _html2df(path_to_html: str) -> pd.DataFrame:
             html = open(path_to_html).read()
 
-            soup = BeautifulSoup(html, 'html.parser')
-            table = soup.find('table', {'class': 'tbl01'})
-            rows = table.findAll('tr')
-            csv = [
-                [cell.get_text() for cell in row.findAll(['td', 'th'])]
-                for row in rows
-            ]
+            cache_path = None
+            if cache_dir:
+                digest = hashlib.sha256(html.encode('utf-8')).hexdigest()
+                cache_path = os.path.join(cache_dir, f'{digest}.csv')
+                if os.path.exists(cache_path):
+                    return pd.read_csv(cache_path, dtype=str, keep_default_na=False)
+
+            csv = _table_rows(html)
             df = pd.DataFrame(csv, columns=csv.pop(0)) \
                     .rename(columns={'銘柄コード': 'code',  # 扱いやすいように半角にしておく
                                     '銘柄名': 'name',
                                     '併合比率': 'rate', '割当比率': 'rate',
                                     '権利付最終日': 'from'})
+            if cache_path:
+                os.makedirs(cache_dir, exist_ok=True)
+                df.to_csv(cache_path, index=False)
             return df
 
-        def _adj_rates(df_in_desc: pd.DataFrame) -> list:
+        def _adj_rates(df_in_desc: pd.DataFrame) -> pd.Series:
             '''
             Parameters
             ----------------------
             df_in_desc: pd.DataFrame
                 日時降順でソートし与えること。
             '''
-            adj_rates_in_each_codes: dict = {}
-            def calc_adj_rates(code: str, rate: float):
-                adj_rates_in_each_codes[code] = adj_rates_in_each_codes.get(code, 1.0) / rate
-                return adj_rates_in_each_codes[code]
-            return [calc_adj_rates(code, rate)
-                for code, rate in df_in_desc[['code', 'rate']].values]
+            # 銘柄毎に、新しい方から 1 / rate を掛けていった値
+            return (1.0 / df_in_desc['rate']) \
+                .groupby(df_in_desc['code'].to_numpy(), sort=False).cumprod()
 
         def _reverse(df: pd.DataFrame) -> pd.DataFrame:
             # https://stackoverflow.com/a/20444256
@@ -71,10 +108,10 @@ class AddAdjClose:
         dfs = pd.concat(_html2df(path_to_html) \
                 for path_to_html in paths_to_html) \
                 .sort_values(['code', 'from'], ascending=False)
-        dfs['rate'] = dfs['rate'].apply(_convert_to_ratio)
+        dfs['rate'] = _convert_to_ratio(dfs['rate'])
         dfs['adj_rate'] = _adj_rates(dfs)
         dfs['adj_rate'] = dfs['adj_rate'].astype(np.float64)
-        dfs['date'] = dfs['from'].apply(cls.three_separated_digits_to_date)
+        dfs['date'] = cls.three_separated_digits_to_dates(dfs['from'])
         return _reverse(dfs)[['code', 'name', 'date', 'rate', 'adj_rate']]
 
     @classmethod
@@ -87,6 +124,90 @@ class AddAdjClose:
             path_to_dill: str='adj_rates.dill') -> pd.DataFrame:
         return dill.load(open(path_to_dill, 'rb'))
 
+    @classmethod
+    def save_as_npy(cls, df: pd.DataFrame,
+            path_to_npy: str='adj_rates.npy'):
+        '''
+        終値調整比のDFを、銘柄コード・日付順に並べた NumPy の構造化配列として保存する。
+        load_from_npy で mmap して、必要な銘柄の行だけを読める。
+        '''
+        sorted_df = df.sort_values(['code', 'date'], kind='stable')
+        codes = sorted_df['code'].astype(str).to_numpy(dtype=str)
+        names = sorted_df['name'].astype(str).to_numpy(dtype=str)
+        rates = np.empty(len(sorted_df), dtype=[
+            ('code', codes.dtype), ('name', names.dtype),
+            ('date', '<i8'),  # UTCのエポックナノ秒
+            ('rate', '<f8'), ('adj_rate', '<f8')])
+        rates['code'] = codes
+        rates['name'] = names
+        rates['date'] = pd.to_datetime(sorted_df['date'], utc=True) \
+            .values.astype('datetime64[ns]').astype(np.int64)
+        rates['rate'] = sorted_df['rate'].to_numpy(dtype=np.float64)
+        rates['adj_rate'] = sorted_df['adj_rate'].to_numpy(dtype=np.float64)
+        with open(path_to_npy, 'wb') as f:
+            np.save(f, rates, allow_pickle=False)
+
+    @classmethod
+    def load_from_npy(cls, path_to_npy: str='adj_rates.npy',
+            code: Union[str, int, None]=None) -> pd.DataFrame:
+        '''
+        save_as_npy で保存したものを mmap で開き、DFで返す。
+        code を与えたら、二分探索でその銘柄の行だけを読む。
+        '''
+        rates = np.load(path_to_npy, mmap_mode='r', allow_pickle=False)
+        if code is not None:
+            code = np.array(str(code), dtype=rates.dtype['code'])
+            head = np.searchsorted(rates['code'], code, side='left')
+            tail = np.searchsorted(rates['code'], code, side='right')
+            rates = rates[head:tail]
+        return pd.DataFrame({
+            'code': rates['code'].astype(str).astype(object),
+            'name': rates['name'].astype(str).astype(object),
+            'date': pd.to_datetime(np.asarray(rates['date']), utc=True).tz_convert(cls.JST),
+            'rate': np.asarray(rates['rate']),
+            'adj_rate': np.asarray(rates['adj_rate']),
+        })
+
+    @classmethod
+    def load_from_dill_cached(cls,
+            path_to_dill: str='adj_rates.dill') -> pd.DataFrame:
+        '''
+        load_from_dill のプロセス内キャッシュ版。
+        ファイルの更新日時が変わっていなければ、前回読み込んだDFを返す。
+        返すDFはプロセス内で共有しているので、変更しないこと。
+        '''
+        return cls._cached_adj_rates(path_to_dill)[1]
+
+    @classmethod
+    def load_from_dill_cached_for_code(cls, code: Union[str, int],
+            path_to_dill: str='adj_rates.dill') -> pd.DataFrame:
+        '''
+        load_from_dill_cached の、指定した銘柄コードの行だけを返す版。
+        銘柄コードの索引もキャッシュしているので、全行を走査しない。
+        '''
+        return cls._cached_adj_rates(path_to_dill)[2].for_code(code)
+
+    @classmethod
+    def load_adj_rate_index_cached(cls,
+            path_to_dill: str='adj_rates.dill') -> AdjRateIndex:
+        '''
+        load_from_dill_cached の、索引を付けたものを返す版。
+        '''
+        return cls._cached_adj_rates(path_to_dill)[2]
+
+    @classmethod
+    def _cached_adj_rates(cls, path_to_dill: str) \
+            -> Tuple[float, pd.DataFrame, AdjRateIndex]:
+        mtime = os.stat(path_to_dill).st_mtime
+        key = os.path.abspath(path_to_dill)
+        with cls._adj_rates_cache_lock:
+            cached = cls._adj_rates_cache.get(key)
+            if cached is None or cached[0] != mtime:
+                adj_rate_df = cls.load_from_dill(path_to_dill)
+                cached = (mtime, adj_rate_df, AdjRateIndex(adj_rate_df))
+                cls._adj_rates_cache[key] = cached
+            return cached
+
     @classmethod
     def eight_digits_to_date(cls, date_str: Union[str, int]) -> datetime:
         '''
@@ -105,55 +226,187 @@ class AddAdjClose:
         ymd = map(lambda x: int(x), re.split('[-/ ]', date_str)[0:3])
         return datetime(*ymd, 15, 0, 0, tzinfo=cls.JST)
 
+    @classmethod
+    def three_separated_digits_to_dates(cls, date_strs: pd.Series) -> pd.Series:
+        '''
+        three_separated_digits_to_date を、Seriesのまままとめて行う版。
+        '''
+        ymd = date_strs.str.split('[-/ ]', regex=True, expand=True).iloc[:, 0:3].astype(int)
+        ymd.columns = ['year', 'month', 'day']
+        dates = pd.to_datetime(ymd) + pd.Timedelta(hours=15)
+        return dates.dt.tz_localize(cls.JST)
+
+    # KABU+ のCSVの列名 -> 扱いやすい列名
+    HIST_DATA_COLUMNS: Dict[str, str] = {'SC': 'code', '名称': 'name', \
+                    '市場': 'market', '業種': 'industry', \
+                    '日付': 'date', '日時': 'date', '株価': 'close', \
+                    '始値': 'open', '高値': 'high', '安値': 'low', \
+                    '出来高': 'volumes'}
+    # 価格は型を推定させ、整数だけの列は整数のまま書き出す。
+    # 出来高は '-' (欠損) を含んでも整数のまま書き出せるよう、nullable な Int64 で読む
+    HIST_DATA_DTYPES: Dict[str, Union[type, str]] = {'SC': str, '名称': str, \
+                    '市場': str, '業種': str, \
+                    '日付': str, '日時': str, '出来高': 'Int64'}
+
     @classmethod
     def hist_data(cls, filepath: str) -> pd.DataFrame:
         '''
         銘柄コード、年を指定して、CSVを読み込み、DFを返す。
+        使う列だけを型を決めて読み、日付はまとめて変換する。
         '''
-        csv = pd.read_csv(filepath, encoding='shift_jis')
-        columns = {'SC': 'code', '名称': 'name', \
-                        '市場': 'market', '業種': 'industry', \
-                        '日付': 'date', '日時': 'date', '株価': 'close', \
-                        '始値': 'open', '高値': 'high', '安値': 'low', \
-                        '出来高': 'volumes'}
-        csv = csv.rename(columns=columns)
-        the_first_date: str = csv['date'][0]
-        if len(the_first_date) == 8:  # yyyymmdd
-            csv['date'] = csv['date'].apply(cls.eight_digits_to_date)
-        else:  # yyyy/mm/dd HH:MM and so on
-            csv['date'] = csv['date'].apply(cls.three_separated_digits_to_date)
-        filter_column: list = dict.fromkeys(columns.values())
+        csv = pd.read_csv(filepath, encoding='shift_jis',
+                          usecols=lambda column: column in cls.HIST_DATA_COLUMNS,
+                          dtype=cls.HIST_DATA_DTYPES,
+                          na_values=['-'])  # KABU+ は値が無いと '-' になる
+        csv = csv.rename(columns=cls.HIST_DATA_COLUMNS)
+        csv['date'] = cls.digits_to_dates(csv['date'])
+        filter_column: list = dict.fromkeys(cls.HIST_DATA_COLUMNS.values())
         return_val: pd.DataFrame = csv.filter(filter_column)  # filterして返す
         return return_val
 
     @classmethod
-    def _bizdays(cls, year: int) -> pd.DataFrame:
-        biz_days = jpbizday.year_bizdays(int(year))
-        biz_dts = map(lambda x: \
-            datetime(x.year, x.month, x.day, 15, 0, 0, tzinfo=cls.JST), biz_days)
-        bizdays_df = pd.DataFrame({'date': biz_dts}).set_index('date')
-        return bizdays_df
+    def digits_to_dates(cls, date_strs: pd.Series) -> pd.Series:
+        '''
+        YYYYMMDD や YYYY/MM/DD HH:MM などのstrのSeriesを、その日の 15:00 JST にまとめて変換する。
+        '''
+        if len(date_strs) > 0 and len(date_strs.iloc[0]) == 8:  # yyyymmdd
+            dates = pd.to_datetime(date_strs, format='%Y%m%d') + pd.Timedelta(hours=15)
+            return dates.dt.tz_localize(cls.JST)
+        # yyyy/mm/dd HH:MM and so on
+        return cls.three_separated_digits_to_dates(date_strs)
 
     @classmethod
     def hist_data_with_adj_close(cls, hist_data: pd.DataFrame, \
-            code: str, year: str, adj_rate_df: pd.DataFrame) -> pd.DataFrame:
-        '''
-        銘柄コード、年、終値調整用比のDFから、調整後終値付きのDFを返す。
-        '''
-        adj_rate_for_current_stock: pd.DataFrame = \
-            adj_rate_df[adj_rate_df['code'] == str(code)]
-        joined = cls._bizdays(year).merge(adj_rate_for_current_stock, \
-                                    on='date', how='left') \
-                            .set_index('date').shift() \
-                            .fillna(method='ffill').fillna(1.0)
-        adj = joined.loc[:, ['adj_rate']]
-        #hist = hist_data(input_filepath)
-        hist = hist_data.merge(adj, on='date', how='left')
+            code: str, year: str, adj_rate_df: AdjRates) -> pd.DataFrame:
+        '''
+        銘柄コード、終値調整用比のDFから、調整後終値付きのDFを返す。
+        各日付の adj_rate は、その日より前の適用日のうち最新のもの (無ければ 1.0) で、
+        hist_data より前の年の併合・分割も反映する。hist_data は複数年にまたがってもよい。
+        year は使わない。呼び出し側との互換のために残してある。
+        '''
+        hist = hist_data.assign(
+            adj_rate=cls._adj_rate_index_for_code(adj_rate_df, code).asof(code, hist_data['date']))
         latest_rate = hist.iloc[-1]['adj_rate']
         hist['adj_close'] = hist['close'] * (latest_rate / hist['adj_rate'])
         hist = hist.set_index('date')
         return hist
 
+    @classmethod
+    def _adj_rates_for_code(cls, adj_rate_df: AdjRates, code: str) -> pd.DataFrame:
+        '''
+        終値調整比のうち、その銘柄の行だけのDF。
+        AdjRateIndex なら索引で引くので、全行を走査しない。
+        '''
+        if isinstance(adj_rate_df, AdjRateIndex):
+            return adj_rate_df.for_code(code)
+        return adj_rate_df[adj_rate_df['code'] == str(code)]
+
+    @classmethod
+    def _adj_rate_index_for_code(cls, adj_rate_df: AdjRates, code: str) -> AdjRateIndex:
+        '''
+        その銘柄の as-of な引き当てに使う AdjRateIndex。
+        DFなら、その銘柄の行だけで索引を作る。
+        '''
+        if isinstance(adj_rate_df, AdjRateIndex):
+            return adj_rate_df
+        return AdjRateIndex(cls._adj_rates_for_code(adj_rate_df, code))
+
+    @classmethod
+    def needs_rescale(cls, last_date: datetime, until: datetime, code: str,
+            adj_rate_df: AdjRates) -> bool:
+        '''
+        last_date まで調整後終値を付けた後、until までの行を追記する間に、
+        その銘柄の併合・分割があれば True。
+        その場合は、それまでの調整後終値を全て付け直す必要がある。
+        適用日は次営業日から有効なので、until 当日以降の併合・分割 (先の予定も含む) は
+        追記する行に影響せず、付け直す必要は無い。
+        終値調整比のDFには、過去の日付の行が後から増えないものとする。
+        '''
+        dates = cls._adj_rates_for_code(adj_rate_df, code)['date']
+        return bool(((dates >= last_date) & (dates < until)).any())
+
+    @classmethod
+    def append_hist_data_with_adj_close(cls, path: str, hist_data: pd.DataFrame,
+            code: str, adj_rate_df: AdjRates) -> int:
+        '''
+        path に書き出してある調整後終値付きのCSVに、hist_data のうち新しい日付の行を追記する。
+        CSVには終値と終値調整比 (adj_rate) が残っているので、
+        新たな併合・分割が無ければ、追記する行だけを計算してファイル末尾に書き足す。
+        併合・分割が載っていたら、CSVの終値から全体を計算し直して書き直す。
+        CSVが無ければ hist_data から作る。追記 (書き直した場合も) した行数を返す。
+        '''
+        if not os.path.exists(path):
+            adj_hist = cls._hist_data_with_adj_close_over_years(hist_data, code, adj_rate_df)
+            adj_hist.to_csv(path)
+            return len(adj_hist)
+
+        last_row = cls._read_last_row(path)
+        last_date = last_row['date'].iloc[0]
+        new_rows = hist_data[hist_data['date'] > last_date]
+        if len(new_rows) == 0:
+            return 0
+
+        if not cls.needs_rescale(last_date, new_rows['date'].max(), code, adj_rate_df):
+            # 追記する期間に併合・分割が無いので、追記する行の終値調整比は最後の行と同じで、
+            # 最新の終値調整比も変わらない
+            latest_rate = last_row['adj_rate'].iloc[0]
+            appended = new_rows.assign(adj_rate=latest_rate)
+            appended['adj_close'] = appended['close'] * (latest_rate / appended['adj_rate'])
+            appended.set_index('date')[last_row.columns.drop('date')] \
+                .to_csv(path, mode='a', header=False)
+            return len(appended)
+
+        adj_hist = pd.read_csv(path, dtype={'code': str})
+        adj_hist['date'] = pd.to_datetime(adj_hist['date']).dt.tz_convert(cls.JST)
+        raw = pd.concat([adj_hist.drop(columns=['adj_rate', 'adj_close']), new_rows])
+        rescaled = cls._hist_data_with_adj_close_over_years(raw, code, adj_rate_df)
+        rescaled.to_csv(path)
+        return len(new_rows)
+
+    @classmethod
+    def _hist_data_with_adj_close_over_years(cls, hist_data: pd.DataFrame,
+            code: str, adj_rate_df: AdjRates) -> pd.DataFrame:
+        '''
+        hist_data_with_adj_close の、hist_data が複数年にまたがってもよい版。
+        '''
+        return cls.hist_data_with_adj_close(
+            hist_data, code, None, adj_rate_df)
+
+    @classmethod
+    def _read_last_row(cls, path: str, tail_bytes: int=4096) -> pd.DataFrame:
+        '''
+        CSVのヘッダと最後の行だけを読む。
+        '''
+        with open(path, 'rb') as f:
+            header = f.readline()
+            f.seek(0, os.SEEK_END)
+            f.seek(max(f.tell() - tail_bytes, len(header)))
+            last_line = f.read().rstrip(b'\r\n').rsplit(b'\n', 1)[-1]
+        last_row = pd.read_csv(io.BytesIO(header + last_line), dtype={'code': str})
+        last_row['date'] = pd.to_datetime(last_row['date']).dt.tz_convert(cls.JST)
+        return last_row
+
+    @classmethod
+    def hist_data_with_adj_close_batch(cls, hist_data: pd.DataFrame, \
+            codes: List[str], year: str, adj_rate_df: AdjRates) -> Dict[str, pd.DataFrame]:
+        '''
+        hist_data_with_adj_close を複数銘柄まとめて行い、銘柄コード -> 調整後終値付きのDF を返す。
+        終値調整比は AdjRateIndex.asof_join で全銘柄まとめて引き当てる。
+        hist_data に複数銘柄が含まれていれば、銘柄コードと日付で突き合わせる。
+        year は使わない。呼び出し側との互換のために残してある。
+        '''
+        codes = list(dict.fromkeys(str(code) for code in codes))
+        index = adj_rate_df if isinstance(adj_rate_df, AdjRateIndex) \
+            else AdjRateIndex(adj_rate_df[adj_rate_df['code'].isin(codes)])
+
+        hist = hist_data.assign(_code=hist_data['code'].astype(str))
+        hist = hist[hist['_code'].isin(codes)]
+        hist = hist.assign(adj_rate=index.asof_join(hist))
+        latest_rate = hist.groupby('_code', sort=False)['adj_rate'].transform('last')
+        hist['adj_close'] = hist['close'] * (latest_rate / hist['adj_rate'])
+        return {code: df.drop(columns='_code').set_index('date')
+            for code, df in hist.groupby('_code', sort=False)}
+
 
 def parse_args(args: list=[]) -> argparse.Namespace:
     parser = argparse.ArgumentParser(
@@ -166,11 +419,15 @@ def parse_args(args: list=[]) -> argparse.Namespace:
 
     parser.add_argument('--output', '-o', default=None, type=str,
                         required=False, action='store',
-                        help='output file path')
+                        help='output file path (%%s: code, {stem}: input file name with --input-glob)')
+
+    parser.add_argument('--input-glob', default=None, type=str,
+                        required=False, action='store',
+                        help='input file glob (e.g. "./kabu_plus/**/*.csv"), converted in parallel')
 
     parser.add_argument('--year', '-y', default=None, type=int,
                         required=False, action='store',
-                        help='the year of file path')
+                        help='unused; kept for compatibility')
 
     parser.add_argument('--codes', '-c', default=None, type=str,
                         required=False, action='store',
@@ -184,6 +441,26 @@ def parse_args(args: list=[]) -> argparse.Namespace:
                         required=False, action='store',
                         help='dill output file path')
 
+    parser.add_argument('--jobs', '-j', default=os.cpu_count(), type=int,
+                        required=False, action='store',
+                        help='the number of output files (or input files with --input-glob) processed in parallel')
+
+    parser.add_argument('--npy-input', default=None, type=str,
+                        required=False, action='store',
+                        help='npy input file path (instead of dill)')
+
+    parser.add_argument('--npy-output', default=None, type=str,
+                        required=False, action='store',
+                        help='npy output file path')
+
+    parser.add_argument('--append', default=False,
+                        required=False, action='store_true',
+                        help='append only new dates to the existing output files (rewrite them if a new heigou/bunkatsu is found)')
+
+    parser.add_argument('--factors-output', default=None, type=str,
+                        required=False, action='store',
+                        help='npy output file path of the adjustment factors for the feeds')
+
     parser.add_argument('--heigou-input', default=None, type=str,
                         required=False, action='store',
                         help='heigou html input file path')
@@ -192,29 +469,143 @@ def parse_args(args: list=[]) -> argparse.Namespace:
                         required=False, action='store',
                         help='bunkatsu html input file path')
 
+    parser.add_argument('--html-cache-dir', default=None, type=str,
+                        required=False, action='store',
+                        help='directory to cache tables parsed from the html inputs')
+
     if args:
         return parser.parse_args(args)
     return parser.parse_args()
 
+_worker_adj_rate_df: AdjRates = None  # convert_files のワーカープロセス毎に1回だけ受け取る
+
+def _init_convert_worker(adj_rate_df: AdjRates):
+    global _worker_adj_rate_df
+    _worker_adj_rate_df = adj_rate_df
+
+def _convert_file_in_worker(input_path: str, output: str,
+        codes: List[str]=None, year: int=None) -> List[str]:
+    ''' convert_files のワーカープロセスで、受け取っておいた終値調整比を使って convert_file する '''
+    return convert_file(input_path, output, _worker_adj_rate_df, codes, year)
+
+def _stamp_path(input_path: str, output: str) -> str:
+    '''
+    入力ファイル毎に、書き出した出力ファイルの一覧を記録するファイル。
+    '''
+    stem = os.path.splitext(os.path.basename(input_path))[0]
+    output_dir = os.path.dirname(output.format(stem=stem)) or '.'
+    return os.path.join(output_dir, f'.{stem}.done')
+
+def _stamp_options(codes: List[str]=None, year: int=None) -> str:
+    '''
+    記録ファイルの1行目。変換時のオプションが違えば、出力ファイルが新しくても変換し直す。
+    '''
+    return '# codes={} year={}'.format(','.join(map(str, codes)) if codes else '*', year or '*')
+
+def _is_up_to_date(input_path: str, output: str, deps_mtime: float,
+        codes: List[str]=None, year: int=None) -> bool:
+    '''
+    前回と同じオプションで変換していて、その出力ファイルが全て、
+    入力ファイル(と終値調整比の元ファイル)より新しければTrue。
+    '''
+    stamp_path = _stamp_path(input_path, output)
+    if not os.path.exists(stamp_path):
+        return False
+    options, *outputs = open(stamp_path).read().split('\n')
+    if options != _stamp_options(codes, year):
+        return False
+    input_mtime = max(os.stat(input_path).st_mtime, deps_mtime)
+    return all(os.path.exists(path) and os.stat(path).st_mtime >= input_mtime
+        for path in [stamp_path, *filter(None, outputs)])
+
+def convert_file(input_path: str, output: str, adj_rate_df: AdjRates,
+        codes: List[str]=None, year: int=None) -> List[str]:
+    '''
+    1つのKABU+ CSVを変換し、銘柄毎に書き出す。書き出したファイルのパスを返す。
+    codes を省略したら、ファイルに含まれる全銘柄を変換する。
+    year は hist_data_with_adj_close_batch と同じく使わないが、.done には記録する。
+    '''
+    stamp_options = _stamp_options(codes, year)
+    stem = os.path.splitext(os.path.basename(input_path))[0]
+    hist_data_df: pd.DataFrame = AddAdjClose.hist_data(input_path)
+    codes = codes or hist_data_df['code'].astype(str).unique().tolist()
+    hist_data_with_adj_close = AddAdjClose.hist_data_with_adj_close_batch(
+        hist_data_df, codes, year, adj_rate_df)
+    outputs = []
+    for code, df in hist_data_with_adj_close.items():
+        path = output.format(stem=stem) % code
+        df.to_csv(path)
+        outputs.append(path)
+    with open(_stamp_path(input_path, output), 'w') as f:
+        f.write('\n'.join([stamp_options, *outputs]))
+    return outputs
+
+def convert_files(input_glob: str, output: str, adj_rate_df: AdjRates,
+        codes: List[str]=None, year: int=None, jobs: int=None, deps_mtime: float=0.0) -> List[str]:
+    '''
+    input_glob に当てはまるファイルを、プロセスプールで並行に変換する。
+    前回と同じ codes, year で変換していて、その出力が入力 (と deps_mtime) より新しいファイルは飛ばす。
+    変換したファイルのパスを返す。
+    '''
+    input_paths = sorted(path for path in glob.glob(input_glob, recursive=True)
+        if not _is_up_to_date(path, output, deps_mtime, codes, year))
+    with ProcessPoolExecutor(max_workers=jobs,
+            initializer=_init_convert_worker, initargs=(adj_rate_df,)) as executor:
+        futures = {executor.submit(_convert_file_in_worker, path, output, codes, year): path
+            for path in input_paths}
+        for future, path in futures.items():
+            print(f'Converted {path}: {len(future.result())} codes')
+    return input_paths
+
 def main(args=[]):
     args = parse_args(args)
-    if args.dill_input:
+    if args.npy_input:
+        print('Use the existed npy')
+        adj_rate_df = AddAdjClose.load_from_npy(args.npy_input)
+    elif args.dill_input:
         print('Use the existed dill')
         adj_rate_df = AddAdjClose.load_from_dill(args.dill_input)
     else:
         print('Create a new dill')
         adj_rate_df = AddAdjClose.get_adj_rate(
-            (args.heigou_input, args.bunkatsu_input))
+            (args.heigou_input, args.bunkatsu_input), cache_dir=args.html_cache_dir)
     if args.dill_output:
         AddAdjClose.save_as_dill(adj_rate_df, args.dill_output)
+    if args.npy_output:
+        AddAdjClose.save_as_npy(adj_rate_df, args.npy_output)
+    # 銘柄毎に引くので、索引を1回だけ作っておく
+    adj_rate_df = AdjRateIndex(adj_rate_df)
+    if args.factors_output:
+        AdjFactors.from_adj_rates(adj_rate_df).save(args.factors_output)
+
+    if args.input_glob:
+        if '{stem}' not in args.output:
+            raise ValueError('--output must contain {stem} with --input-glob')
+        # 終値調整比の元になったファイル。HTMLから作ったなら、そのHTML
+        rates_paths = [args.npy_input or args.dill_input] \
+            if args.npy_input or args.dill_input else [args.heigou_input, args.bunkatsu_input]
+        deps_mtime = max((os.stat(path).st_mtime for path in rates_paths if path), default=0.0)
+        codes = args.codes.split(',') if args.codes else None
+        convert_files(args.input_glob, args.output, adj_rate_df,
+            codes=codes, year=args.year, jobs=args.jobs, deps_mtime=deps_mtime)
 
     if args.input:
         year = args.year
         codes = args.codes.split(',')
         hist_data_df: pd.DataFrame = AddAdjClose.hist_data(args.input)
-        [AddAdjClose.hist_data_with_adj_close(
-            hist_data_df, code, year, adj_rate_df) \
-                .to_csv(args.output % code) for code in codes]
+        if args.append:
+            hist_data_df['code'] = hist_data_df['code'].astype(str)
+            hist_data_by_code = {code: hist_data_df[hist_data_df['code'] == str(code)]
+                for code in codes}
+            with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+                list(executor.map(lambda code: AddAdjClose.append_hist_data_with_adj_close(
+                    args.output % code, hist_data_by_code[code], code, adj_rate_df), codes))
+            return
+        hist_data_with_adj_close = AddAdjClose.hist_data_with_adj_close_batch(
+            hist_data_df, codes, year, adj_rate_df)
+        with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+            list(executor.map(lambda item: item[1].to_csv(args.output % item[0]),
+                hist_data_with_adj_close.items()))
 
 if __name__ == '__main__':
     if __debug__:
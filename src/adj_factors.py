@@ -0,0 +1,112 @@
+import os
+import threading
+from typing import Dict, Tuple, Union
+
+import numpy as np
+import pandas as pd
+
+from adj_rate_index import AdjRateIndex
+from jp_bizday_calendar import JPBizdayCalendar
+
+Code = Union[str, int]
+
+class AdjFactors:
+    '''
+    終値調整比から前もって求めておく、銘柄毎の価格の調整係数。
+    銘柄毎に (start, factor) の階段関数として持ち、start (UTCのエポックナノ秒) 以降の
+    価格に factor を掛け、出来高を factor で割ると、最新の株数基準に揃う。
+    併合・分割は、権利付最終日の次営業日の 00:00 JST から反映する。
+
+    save した .npy はどのフィードからも load でき、歩み値のようにtick毎の配列でも、
+    searchsorted と掛け算だけで調整できる。
+    '''
+    TZ = 'Asia/Tokyo'
+    # path -> (mtime, load の結果)
+    _cache: Dict[str, Tuple[float, 'AdjFactors']] = {}
+    _cache_lock: threading.Lock = threading.Lock()
+
+    def __init__(self, factors: np.ndarray):
+        '''
+        factors: code, start, factor を持つ構造化配列。銘柄コード・start順に並べて与えること。
+        '''
+        self.factors: np.ndarray = factors
+        codes = factors['code']
+        uniq_codes, heads, counts = np.unique(codes, return_index=True, return_counts=True)
+        self.slices: Dict[str, slice] = {str(code): slice(head, head + count)
+            for code, head, count in zip(uniq_codes, heads, counts)}
+        self.starts: np.ndarray = np.asarray(factors['start'])
+        self.values: np.ndarray = np.asarray(factors['factor'])
+
+    @classmethod
+    def from_adj_rates(cls, adj_rate_df: Union[pd.DataFrame, AdjRateIndex]) -> 'AdjFactors':
+        '''
+        終値調整比のDF (または AdjRateIndex) から、全銘柄分をまとめて求める。
+        '''
+        index = adj_rate_df if isinstance(adj_rate_df, AdjRateIndex) \
+            else AdjRateIndex(adj_rate_df)
+        codes = index.df['code'].astype(str).to_numpy(dtype=str)
+        uniq_codes = np.array(index.codes(), dtype=codes.dtype)
+        counts = np.array([s.stop - s.start for s in index.slices.values()])
+        tails = np.array([s.stop - 1 for s in index.slices.values()], dtype=np.int64)
+        # hist_data_with_adj_close と同じく、最新の終値調整比との比を掛けて最新の株数基準にする
+        latest_rates = index.adj_rates[tails]
+        factors = np.repeat(latest_rates, counts) / index.adj_rates
+
+        days = pd.DatetimeIndex(pd.to_datetime(index.dates, utc=True)) \
+            .tz_convert(cls.TZ).tz_localize(None).values.astype('datetime64[D]')
+        years = days.astype('datetime64[Y]').astype(int) + 1970
+        calendar = JPBizdayCalendar.of(int(years.min()), int(years.max()) + 1)
+        starts = pd.DatetimeIndex(calendar.next_bizday(days)) \
+            .tz_localize(cls.TZ).asi8
+
+        heads = np.empty(len(uniq_codes), dtype=[('code', codes.dtype), ('start', '<i8'), ('factor', '<f8')])
+        heads['code'] = uniq_codes
+        heads['start'] = np.iinfo(np.int64).min  # 最初の併合・分割より前
+        heads['factor'] = latest_rates  # 終値調整比は 1.0
+        steps = np.empty(len(codes), dtype=heads.dtype)
+        steps['code'] = codes
+        steps['start'] = starts
+        steps['factor'] = factors
+        merged = np.concatenate([heads, steps])
+        return cls(merged[np.lexsort((merged['start'], merged['code']))])
+
+    def save(self, path_to_npy: str='adj_factors.npy'):
+        with open(path_to_npy, 'wb') as f:
+            np.save(f, self.factors, allow_pickle=False)
+
+    @classmethod
+    def load(cls, path_to_npy: str='adj_factors.npy') -> 'AdjFactors':
+        return cls(np.load(path_to_npy, mmap_mode='r', allow_pickle=False))
+
+    @classmethod
+    def load_cached(cls, path_to_npy: str='adj_factors.npy') -> 'AdjFactors':
+        '''
+        load のプロセス内キャッシュ版。ファイルの更新日時が変わっていなければ、前回のものを返す。
+        '''
+        mtime = os.stat(path_to_npy).st_mtime
+        key = os.path.abspath(path_to_npy)
+        with cls._cache_lock:
+            cached = cls._cache.get(key)
+            if cached is None or cached[0] != mtime:
+                cached = (mtime, cls.load(path_to_npy))
+                cls._cache[key] = cached
+            return cached[1]
+
+    def factor(self, code: Code, timestamps: np.ndarray) -> np.ndarray:
+        '''
+        各時刻 (UTCのエポックナノ秒) の調整係数。併合・分割の無い銘柄は 1.0。
+        '''
+        timestamps = np.asarray(timestamps, dtype=np.int64)
+        s = self.slices.get(str(code))
+        if s is None:
+            return np.ones(len(timestamps))
+        index = np.searchsorted(self.starts[s], timestamps, side='right') - 1
+        return self.values[s][index]
+
+    def adjust(self, code: Code, timestamps: np.ndarray,
+            prices: np.ndarray, volumes: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        '''
+        価格・出来高を、最新の株数基準に調整したものを返す。
+        '''
+        factors = self.factor(code, timestamps)
+        return prices * factors, volumes / factors
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: utf-8; py-indent-offset:4 -*-
+'''
+KabuPlusJPCSVData で、adj_rates_path (終値調整比) と adj_factors_path (調整係数) の
+どちらで調整しても、同じバーになることを確かめる。
+
+    python adj_factors_test.py --data0=japan-stock-prices_2020_9143.csv \
+        --adj-rates-path=rates_df.dill --adj-factors-path=adj_factors.npy
+'''
+import argparse
+import sys
+
+import backtrader as bt
+import numpy as np
+
+from kabu_plus_jp_csv_data import KabuPlusJPCSVData
+
+FIELDS = ('datetime', 'open', 'high', 'low', 'close', 'volume')
+
+
+class RecordBarsStrategy(bt.Strategy):
+    def __init__(self):
+        self.bars = list()
+
+    def next(self):
+        self.bars.append([getattr(self.data, field)[0] for field in FIELDS])
+
+
+def run_bars(dataname: str, **kwargs) -> np.ndarray:
+    cerebro = bt.Cerebro(stdstats=False)
+    cerebro.addstrategy(RecordBarsStrategy)
+    cerebro.adddata(KabuPlusJPCSVData(dataname=dataname, **kwargs))
+    strategy = cerebro.run()[0]
+    return np.array(strategy.bars, dtype=np.float64).reshape(-1, len(FIELDS))
+
+
+def parse_args(args: list=[]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description='Check that adj_rates_path and adj_factors_path give the same bars')
+    parser.add_argument('--data0', required=True, action='store',
+                        help='KABU+ の調整前の株価CSV')
+    parser.add_argument('--adj-rates-path', default='./rates_df.dill', action='store',
+                        help='終値調整比のファイル (.dill or .npy)')
+    parser.add_argument('--adj-factors-path', default='./adj_factors.npy', action='store',
+                        help='add_adj_close.py --factors-output で作った調整係数のファイル')
+    parser.add_argument('--rtol', default=1e-9, type=float, action='store',
+                        help='許容する相対誤差')
+    if args:
+        return parser.parse_args(args)
+    return parser.parse_args()
+
+
+def main(args=[]) -> int:
+    args = parse_args(args)
+    by_rates = run_bars(args.data0, adj_rates_path=args.adj_rates_path)
+    by_factors = run_bars(args.data0, adj_factors_path=args.adj_factors_path)
+
+    if by_rates.shape != by_factors.shape:
+        print('Bar counts differ: adj_rates_path=%d, adj_factors_path=%d'
+            % (len(by_rates), len(by_factors)))
+        return 1
+    mismatched = ~np.isclose(by_rates, by_factors, rtol=args.rtol, atol=0.0).all(axis=1)
+    for i in np.flatnonzero(mismatched)[:10]:
+        print('Bar %d differs:' % i)
+        print('  adj_rates_path:  ', dict(zip(FIELDS, by_rates[i])))
+        print('  adj_factors_path:', dict(zip(FIELDS, by_factors[i])))
+    if mismatched.any():
+        print('%d of %d bars differ' % (mismatched.sum(), len(by_rates)))
+        return 1
+    print('%d bars are the same' % len(by_rates))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
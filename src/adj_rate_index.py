@@ -0,0 +1,77 @@
+from typing import Dict, List, Union
+
+import numpy as np
+import pandas as pd
+
+Code = Union[str, int]
+
+class AdjRateIndex:
+    '''
+    終値調整比のDF (AddAdjClose.get_adj_rate の結果) を、銘柄コード・日付順に並べ、
+    銘柄コード -> 行の範囲 の索引を付けたもの。
+    銘柄毎の行の取り出しや、日付での as-of な引き当てを、全行を走査せずに行う。
+    AddAdjClose.hist_data_with_adj_close の adj_rate も、asof で引き当てている。
+    作った後に元のDFを変更しても反映されないので、変更しないこと。
+    '''
+    def __init__(self, adj_rate_df: pd.DataFrame):
+        self.df: pd.DataFrame = adj_rate_df \
+            .sort_values(['code', 'date'], kind='stable').reset_index(drop=True)
+        codes = self.df['code'].astype(str).to_numpy()
+        # 銘柄コード順に並べてあるので、各銘柄の行は連続している
+        uniq_codes, heads, counts = np.unique(codes, return_index=True, return_counts=True)
+        self.slices: Dict[str, slice] = {code: slice(head, head + count)
+            for code, head, count in zip(uniq_codes, heads, counts)}
+        self.dates: np.ndarray = self._to_epoch_ns(self.df['date'])
+        self.adj_rates: np.ndarray = self.df['adj_rate'].to_numpy(dtype=np.float64)
+
+    def __len__(self) -> int:
+        return len(self.df)
+
+    def codes(self) -> List[str]:
+        return list(self.slices.keys())
+
+    def for_code(self, code: Code) -> pd.DataFrame:
+        ''' その銘柄の行だけのDF (日付昇順) '''
+        return self.df.iloc[self._slice(code)]
+
+    def for_codes(self, codes: List[Code]) -> pd.DataFrame:
+        ''' 複数銘柄の行だけのDF (銘柄コード・日付順) '''
+        slices = sorted(self._slice(code) for code in set(map(str, codes)))
+        if not slices:
+            return self.df.iloc[0:0]
+        return self.df.iloc[np.concatenate([np.arange(s.start, s.stop) for s in slices])]
+
+    def asof(self, code: Code, dates, default: float=1.0,
+            inclusive: bool=False) -> np.ndarray:
+        '''
+        各日付の時点で最新の、その銘柄の adj_rate を返す。無ければ default。
+        得られる適用日の次営業日から有効なので、既定では適用日当日は含めない。
+        inclusive=True なら適用日当日から有効とする。
+        '''
+        s = self._slice(code)
+        index = np.searchsorted(self.dates[s], self._to_epoch_ns(dates),
+            side='right' if inclusive else 'left')
+        return np.append(default, self.adj_rates[s])[index]
+
+    def asof_join(self, hist_data: pd.DataFrame, default: float=1.0,
+            inclusive: bool=False) -> pd.Series:
+        '''
+        code, date 列を持つDFの各行に、asof で adj_rate を引き当てたSeriesを返す。
+        '''
+        adj_rates = np.empty(len(hist_data), dtype=np.float64)
+        dates = self._to_epoch_ns(hist_data['date'])
+        positions_by_code = hist_data.groupby(
+            hist_data['code'].astype(str).to_numpy(), sort=False).indices
+        for code, positions in positions_by_code.items():
+            adj_rates[positions] = self.asof(code, dates[positions], default, inclusive)
+        return pd.Series(adj_rates, index=hist_data.index, name='adj_rate')
+
+    def _slice(self, code: Code) -> slice:
+        return self.slices.get(str(code), slice(0, 0))
+
+    @classmethod
+    def _to_epoch_ns(cls, dates) -> np.ndarray:
+        ''' tz-awareな日時 (またはエポックナノ秒) を、UTCのエポックナノ秒の配列にする '''
+        if isinstance(dates, np.ndarray) and dates.dtype == np.int64:
+            return dates
+        return pd.DatetimeIndex(pd.to_datetime(dates, utc=True)).asi8
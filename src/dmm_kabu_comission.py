@@ -1,8 +1,8 @@
-from datetime import datetime
+from datetime import datetime, timedelta
 import backtrader as bt
 from kabu_s_logger import KabuSLogger
 
-from typing import NewType, Dict
+from typing import NewType, Dict, Set
 from logging import DEBUG, INFO
 
 from time_and_sales_deliver_feed import TimeAndSalesDeliverData
@@ -19,6 +19,9 @@ class DMMKabuComission(bt.CommInfoBase):
       ('sell_interest', .011),  # 1.1%
       ('interest_long', True),
       ('stocklike', True),  # 信用取引
+      # Trueなら、金利は建玉毎に1日1回、日付が変わって最初に呼ばれた時だけ計算し、
+      # 同じ日の残りの呼び出し(tick毎)では日時の比較だけで 0.0 を返す
+      ('interest_per_day', False),
     )
 
     def __init__(self, logger: KabuSLogger=None):
@@ -26,6 +29,9 @@ class DMMKabuComission(bt.CommInfoBase):
       self._stocklike = self.p.stocklike
       self._interest_last_caluculated_date: datetime = datetime(1900, 1, 1)  # 金利を最後に計算した日付
       self._already_caluculated_positions: AlreadyCaluculatedPositions = {}  # 既に金利計算済みのポジション
+      # interest_per_day 用。データ毎の、次に日付が変わる日時と、その日に金利計算済みのポジション
+      self._next_rollover_dts: Dict[int, datetime] = {}
+      self._caluculated_positions_today: Dict[int, Set[int]] = {}
 
     def _log(self, txt, loglevel=INFO, dt=None):
         ''' Logging function for this strategy '''
@@ -45,18 +51,14 @@ class DMMKabuComission(bt.CommInfoBase):
     # ここから呼ばれる: https://github.com/mementum/backtrader/blob/0fa63ef4a35dc53cc7320813f8b15480c8f85517/backtrader/brokers/bbroker.py#L1189
     def get_credit_interest(self, data, pos, current_dt) -> float:
       '''Calculates the credit due for short selling or product specific'''
-      size, price = pos.size, pos.price
+      if self.p.interest_per_day:
+        return self._get_credit_interest_per_day(data, pos, current_dt)
 
       current_date = current_dt.date()  # カーソルのあるDateTime
-      position_date = pos.datetime.date()  # 建玉の作成DateTime
-      self._debug('current_dt(dt): {}, position_dt(dt): {}'.format(current_dt, pos.datetime), current_dt)
+      debug = self._logger.isEnabledFor(DEBUG)
+      if debug:
+        self._debug('current_dt(dt): {}, position_dt(dt): {}'.format(current_dt, pos.datetime), current_dt)
 
-      # 信用買い／売りした日を1日目とする
-      days = (current_date - position_date).days + 1
-      # 日利
-      interest_percentage: float = (self.p.buy_interest \
-        if size > 0 else self.p.sell_interest) / self.DAYS_IN_A_YEAR
-      
       # 日付けが変わったor金利未計上
       is_to_pay_interests: bool = data.interest_last_caluculated_date < current_date
 
@@ -64,19 +66,61 @@ class DMMKabuComission(bt.CommInfoBase):
         data.interest_last_caluculated_date = current_date
         data.already_caluculated_positions.clear()
 
-      interest_price: float = days * interest_percentage * abs(size) * price
       position_id: int = self._position_id(pos)
 
       if self._is_already_interest_caluculated(pos, data):   # 既に金利計算済みなら
-        self._debug('[Comission/Paid] position_id: {}' \
-          .format(position_id), dt=current_dt)
+        if debug:
+          self._debug('[Comission/Paid] position_id: {}' \
+            .format(position_id), dt=current_dt)
         return 0.0
 
-      self._debug('[Comission] interest_price: {} / position_id: {}' \
-        .format(interest_price, position_id), dt=current_dt)
+      interest_price: float = self._interest_price(pos, current_date)
+      if debug:
+        self._debug('[Comission] interest_price: {} / position_id: {}' \
+          .format(interest_price, position_id), dt=current_dt)
       data.already_caluculated_positions.add(position_id)
       return interest_price
 
+    def _get_credit_interest_per_day(self, data, pos, current_dt) -> float:
+      '''
+      interest_per_day 時の get_credit_interest。
+      日付が変わったら (その日の最初の呼び出しで) 金利計算済みのポジションを忘れ、
+      各ポジションの最初の呼び出しでだけ金利を計算する。
+      データに状態を持たせないので、TimeAndSalesDeliverData 以外のフィードでも使える。
+      '''
+      data_id: int = id(data)
+      next_rollover_dt = self._next_rollover_dts.get(data_id)
+      if next_rollover_dt is None or current_dt >= next_rollover_dt:
+        # 日付が変わった。次の日の 00:00 まではこの日として扱う
+        self._next_rollover_dts[data_id] = current_dt.replace(
+          hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1)
+        caluculated_positions = self._caluculated_positions_today[data_id] = set()
+      else:
+        caluculated_positions = self._caluculated_positions_today[data_id]
+
+      position_id: int = self._position_id(pos)
+      if position_id in caluculated_positions:  # 既に金利計算済みなら
+        return 0.0
+      caluculated_positions.add(position_id)
+
+      interest_price: float = self._interest_price(pos, current_dt.date())
+      if self._logger.isEnabledFor(DEBUG):
+        self._debug('[Comission] interest_price: {} / position_id: {}' \
+          .format(interest_price, position_id), dt=current_dt)
+      return interest_price
+
+    def _interest_price(self, pos: bt.position.Position, current_date) -> float:
+      ''' current_date の時点でそのポジションに掛かる金利 '''
+      size, price = pos.size, pos.price
+      position_date = pos.datetime.date()  # 建玉の作成DateTime
+
+      # 信用買い／売りした日を1日目とする
+      days = (current_date - position_date).days + 1
+      # 日利
+      interest_percentage: float = (self.p.buy_interest \
+        if size > 0 else self.p.sell_interest) / self.DAYS_IN_A_YEAR
+      return days * interest_percentage * abs(size) * price
+
     def _is_already_interest_caluculated(
         self, pos: bt.position.Position, data: TimeAndSalesDeliverData) -> bool:
       ''' 既に金利計算済みならTrueを返す '''
@@ -0,0 +1,81 @@
+import os
+from functools import lru_cache
+from typing import Union
+
+import jpbizday
+import numpy as np
+
+Dates = Union[np.ndarray, list, str]  # np.datetime64 に変換できるもの
+
+class JPBizdayCalendar:
+    '''
+    jpbizday の営業日を、複数年分まとめて datetime64[D] の配列にしておくカレンダー。
+    JPBizdayCalendar.of() で作ったものはプロセス内で使い回す。
+    営業日かどうか・次の営業日・何営業日目か、を配列のまま二分探索で引ける。
+    '''
+    def __init__(self, from_year: int, to_year: int, bizdays: np.ndarray=None):
+        self.from_year = from_year
+        self.to_year = to_year
+        if bizdays is None:
+            bizdays = np.array([day for year in range(from_year, to_year + 1)
+                for day in jpbizday.year_bizdays(year)], dtype='datetime64[D]')
+        self.bizdays: np.ndarray = bizdays
+
+    @classmethod
+    @lru_cache(maxsize=None)
+    def of(cls, from_year: int, to_year: int=None,
+            path_to_npy: str=None) -> 'JPBizdayCalendar':
+        '''
+        from_year から to_year (省略時は from_year) までのカレンダーを返す。
+        path_to_npy を与えたら、そこに保存したものを読み、無ければ作って保存する。
+        '''
+        to_year = from_year if to_year is None else to_year
+        if path_to_npy and os.path.exists(path_to_npy):
+            calendar = cls.load(path_to_npy)
+            if calendar.from_year <= from_year and to_year <= calendar.to_year:
+                return calendar
+        calendar = cls(from_year, to_year)
+        if path_to_npy:
+            calendar.save(path_to_npy)
+        return calendar
+
+    def save(self, path_to_npy: str):
+        with open(path_to_npy, 'wb') as f:
+            np.save(f, self.bizdays, allow_pickle=False)
+
+    @classmethod
+    def load(cls, path_to_npy: str) -> 'JPBizdayCalendar':
+        '''
+        save したカレンダーを読む。期間は保存されている年から決める。
+        '''
+        bizdays = np.load(path_to_npy, allow_pickle=False)
+        years = bizdays.astype('datetime64[Y]').astype(int) + 1970
+        return cls(int(years[0]), int(years[-1]), bizdays)
+
+    def year_bizdays(self, year: int) -> np.ndarray:
+        ''' その年の営業日 '''
+        head, tail = np.searchsorted(self.bizdays, np.array(
+            [f'{year}-01-01', f'{year + 1}-01-01'], dtype='datetime64[D]'))
+        return self.bizdays[head:tail]
+
+    def is_bizday(self, dates: Dates) -> np.ndarray:
+        dates = np.asarray(dates, dtype='datetime64[D]')
+        index = np.searchsorted(self.bizdays, dates)
+        return (index < len(self.bizdays)) \
+            & (self.bizdays[np.minimum(index, len(self.bizdays) - 1)] == dates)
+
+    def next_bizday(self, dates: Dates) -> np.ndarray:
+        '''
+        各日付より後の、最初の営業日。カレンダーの期間外なら NaT。
+        '''
+        dates = np.asarray(dates, dtype='datetime64[D]')
+        index = np.searchsorted(self.bizdays, dates, side='right')
+        padded = np.append(self.bizdays, np.datetime64('NaT', 'D'))
+        return padded[index]
+
+    def bizday_index(self, dates: Dates) -> np.ndarray:
+        '''
+        from_year の最初の営業日を0として、各日付が何営業日目か。
+        営業日でない日付は、その次の営業日と同じ値になる。
+        '''
+        return np.searchsorted(self.bizdays, np.asarray(dates, dtype='datetime64[D]'))
@@ -19,15 +19,20 @@
 
 import io
 from math import e
+from operator import itemgetter
 import pytz
 import re
 from datetime import date, datetime
 from backtrader.utils import date2num
-from typing import Any, List
+from typing import List
 import backtrader as bt
 from add_adj_close import AddAdjClose
+from adj_factors import AdjFactors
+import numpy as np
 import pandas as pd
 
+EPOCH_ORDINAL: int = date(1970, 1, 1).toordinal()  # date2num での 1970-01-01 00:00:00
+
 class KabuPlusJPCSVData(bt.feeds.YahooFinanceCSVData):
     '''
     Parses pre-downloaded KABU+ CSV Data Feeds (or locally generated if they
@@ -49,6 +54,15 @@ class KabuPlusJPCSVData(bt.feeds.YahooFinanceCSVData):
         [2018-11-16] It would seem that the order of *close* and *adjusted
         close* is now fixed. The parameter is retained, in case the need to
         swap the columns again arose.
+      - ``bulk`` (default: ``False``)
+        Read the whole file at once with ``pandas.read_csv``, do the
+        null-row filtering and the adjustment column-wise, and serve the
+        bars from arrays instead of parsing line by line
+      - ``adj_factors_path`` (default: ``None``)
+        With ``load_csv_before_add_adj_close``, adjust the raw prices with
+        the factors precomputed by ``add_adj_close.py --factors-output``
+        instead of ``adj_rates_path``. The bars are the same as with
+        ``adj_rates_path``: adjusted to the last row of the file
     '''
     DATE = 'date'
     OPEN = 'open'
@@ -57,6 +71,8 @@ class KabuPlusJPCSVData(bt.feeds.YahooFinanceCSVData):
     CLOSE = 'close'
     VOLUME = 'volume'
     ADJUSTED_CLOSE = 'adjusted_close'
+    # _loadline で1行から取り出すカラムの順番
+    LOADLINE_COLUMNS = (DATE, OPEN, HIGH, LOW, CLOSE, ADJUSTED_CLOSE, VOLUME)
     
     params = (
         ('reverse', True),
@@ -91,15 +107,25 @@ class KabuPlusJPCSVData(bt.feeds.YahooFinanceCSVData):
         ('delimiter', ','),
         ('newline', '\r\n'),
         ('load_csv_before_add_adj_close', True),  # 調整後終値付加前のデータを読むならTrue
+        ('bulk', False),  # Trueならファイル全体を一度に読んで、配列からバーを返す
+        # 終値調整比のファイル。 .npy なら mmap してこの銘柄の行だけを読む
+        ('adj_rates_path', './rates_df.dill'),
+        # add_adj_close.py --factors-output で作った調整係数のファイル。与えたら adj_rates_path は使わない
+        ('adj_factors_path', None),
     )
 
-    def _fetch_value(self, values: dict, column_name: str) -> Any:
+    _bars: dict = None  # bulk 時の、列毎の配列
+
+    def _compile_columns(self):
         '''
-        パラメタで指定された変換辞書を使用して、
-        CSVで定義されたカラム名に沿って値を取得する。
+        ヘッダを読んだ時点で、内部的なキーからカラムのインデックスへの変換辞書と、
+        LOADLINE_COLUMNS の順で値を取り出す関数を作っておく。
+        行毎に self._csv_headers.index() で探さずに済む。
         '''
-        index = self._column_index(self.p.header_names[column_name])
-        return values[index]
+        self._column_indices = {key: self._column_index(column_name)
+            for key, column_name in self.p.header_names.items()}
+        self._extract_loadline_values = itemgetter(
+            *(self._column_indices[key] for key in self.LOADLINE_COLUMNS))
 
         
     def _column_index(self, column_name: str) -> int:
@@ -117,21 +143,57 @@ class KabuPlusJPCSVData(bt.feeds.YahooFinanceCSVData):
             self._start_without_convert()
 
     def _start_with_convert(self):
-        adj_rates: pd.DataFrame = \
-            AddAdjClose.load_from_dill('./rates_df.dill')
+        '''
+        調整後終値を付加したDFを、CSVに書き出さずにそのままバーにする。
+        '''
+        super(bt.feed.CSVDataBase, self).start()
         hist_data_df: pd.DataFrame = \
             AddAdjClose.hist_data(self.p.dataname)
-        code = hist_data_df.iloc[1:].code
-        year = str(hist_data_df.iloc[1:].date.values[0])[0:4]
-        AddAdjClose.hist_data_with_adj_close(
-        hist_data_df, code, year, adj_rates) \
-            .to_csv('tmp.csv')
-        self.p.dataname = 'tmp.csv'
-        self._start_without_convert()
+        code = hist_data_df['code'].iloc[0]
+        if self.p.adj_factors_path:
+            self._set_bars_with_factors(hist_data_df, code)
+            return
+        if self.p.adj_rates_path.endswith('.npy'):
+            adj_rates: pd.DataFrame = \
+                AddAdjClose.load_from_npy(self.p.adj_rates_path, code=code)
+        else:
+            # 同じプロセスの他のフィードと共有するキャッシュから、この銘柄の分だけ取り出す
+            adj_rates: pd.DataFrame = \
+                AddAdjClose.load_from_dill_cached_for_code(code, self.p.adj_rates_path)
+        converted: pd.DataFrame = AddAdjClose.hist_data_with_adj_close(
+            hist_data_df, code, None, adj_rates).reset_index()
+        converted = converted.dropna(
+            subset=[self.p.header_names[key] for key in self.LOADLINE_COLUMNS])
+        # 日付は 15:00 JST の tz-aware な datetime なので、JSTの日付にする
+        days = converted[self.p.header_names[self.DATE]].dt.tz_convert(self.p.tz) \
+            .dt.tz_localize(None).values.astype('datetime64[D]').astype(np.int64)
+        self._set_bars(converted, days)
+
+    def _set_bars_with_factors(self, hist_data_df: pd.DataFrame, code: str):
+        '''
+        前もって求めておいた調整係数を掛けて調整後終値を作り、バーにする。
+        調整係数は最新の併合・分割基準なので、hist_data_with_adj_close と同じく
+        ファイルの最後の行の基準になるよう、最後の行の係数で割る。
+        '''
+        names = self.p.header_names
+        dates = hist_data_df['date']
+        factors = AdjFactors.load_cached(self.p.adj_factors_path) \
+            .factor(code, pd.DatetimeIndex(dates).asi8)
+        factors = factors / factors[-1]
+        converted = hist_data_df.assign(**{names[self.ADJUSTED_CLOSE]: hist_data_df['close'] * factors})
+        converted = converted.dropna(
+            subset=[names[key] for key in self.LOADLINE_COLUMNS])
+        days = converted[names[self.DATE]].dt.tz_convert(self.p.tz) \
+            .dt.tz_localize(None).values.astype('datetime64[D]').astype(np.int64)
+        self._set_bars(converted, days)
 
     def _start_without_convert(self):
         super(bt.feed.CSVDataBase, self).start()
 
+        if self.p.bulk:
+            self._start_bulk()
+            return
+
         if self.f is None:
             if hasattr(self.p.dataname, 'readline'):
                 self.f = self.p.dataname
@@ -153,9 +215,94 @@ class KabuPlusJPCSVData(bt.feeds.YahooFinanceCSVData):
             #     skipinitialspace=True)
             headers = self._parse_csv_row(line)
             self._csv_headers = headers
+            self._compile_columns()
 
         self.separator = self.p.separator
 
+    def _start_bulk(self):
+        '''
+        ファイル全体を pandas で読み込み、配列からバーを返せるようにしておく。
+        '''
+        names = self.p.header_names
+        df = pd.read_csv(self.p.dataname, encoding=self.p.encoding,
+            sep=self.p.delimiter, quotechar=self.p.quotechar,
+            dtype={names[self.DATE]: str}, na_values=['null'], keep_default_na=False)
+        # 先頭以外のカラムに null がある行は読み飛ばす
+        df = df[~df.iloc[:, 1:].isna().any(axis=1)]
+
+        days = pd.to_datetime(df[names[self.DATE]].str[0:8], format='%Y%m%d') \
+            .values.astype('datetime64[D]').astype(np.int64)
+        self._set_bars(df, days)
+
+    def _set_bars(self, df: pd.DataFrame, days: np.ndarray):
+        '''
+        _loadline と同じ計算を列毎にまとめて行い、_load で返すバーの配列を作る。
+        days は 1970-01-01 からの日数。
+        '''
+        names = self.p.header_names
+        sessionend = date2num(datetime.combine(date(1970, 1, 1), self.p.sessionend)) - EPOCH_ORDINAL
+        o, h, l, rawc, adjustedclose, v = (df[names[key]].to_numpy(dtype=np.float64)
+            for key in (self.OPEN, self.HIGH, self.LOW, self.CLOSE, self.ADJUSTED_CLOSE, self.VOLUME))
+
+        if self.p.swapcloses:  # swap closing prices if requested
+            rawc, adjustedclose = adjustedclose, rawc
+
+        adjfactor = rawc / adjustedclose
+
+        o = o / adjfactor
+        h = h / adjfactor
+        l = l / adjfactor
+        v = v * adjfactor
+
+        if self.p.round:
+            decimals = self.p.decimals
+            o = self._round(o, decimals)
+            h = self._round(h, decimals)
+            l = self._round(l, decimals)
+
+        v = self._round(v, int(self.p.roundvolume))
+
+        self._bars = {
+            'datetime': (days + EPOCH_ORDINAL) + sessionend,
+            'open': o, 'high': h, 'low': l, 'close': adjustedclose, 'volume': v,
+        }
+        self._cursor = 0
+
+    @classmethod
+    def _round(cls, values: np.ndarray, ndigits: int) -> np.ndarray:
+        '''
+        _loadline と同じ組み込みの round で丸める。
+        np.round は 10**ndigits 倍してから丸めるので、端数がちょうど半分付近の値で結果が変わる。
+        '''
+        return np.fromiter((round(value, ndigits) for value in values.tolist()),
+            dtype=np.float64, count=len(values))
+
+    def _load(self):
+        if self._bars is None:
+            return super()._load()
+        i = self._cursor
+        if i >= len(self._bars['datetime']):
+            return False
+        self._cursor = i + 1
+        self.lines.datetime[0] = self._bars['datetime'][i]
+        self.lines.open[0] = self._bars['open'][i]
+        self.lines.high[0] = self._bars['high'][i]
+        self.lines.low[0] = self._bars['low'][i]
+        self.lines.close[0] = self._bars['close'][i]
+        self.lines.volume[0] = self._bars['volume'][i]
+        self.lines.openinterest[0] = 0.0
+        return True
+
+    def preload(self):
+        if self._bars is None:
+            return super().preload()
+        while self.load():
+            pass
+
+        self._last()
+        self.home()
+        self._bars = None  # 読み終わったので手放す
+
     # CSVとしての読み込みがうまくいかないので、手動でパースする
     def _parse_csv_row(self, row: str) -> List[str]:
         return self._remove_quotes_newlines(row).split(',')
@@ -187,20 +334,21 @@ class KabuPlusJPCSVData(bt.feeds.YahooFinanceCSVData):
         linetokens = list(map(self._remove_quotes_newlines,
                             linetokens_with_quotes_newlines))
 
-        dttxt = self._fetch_value(linetokens, self.DATE) # e.g. 20210104
+        dttxt, o, h, l, rawc, adjustedclose, v = \
+            self._extract_loadline_values(linetokens)  # dttxt: e.g. 20210104
         dt = date(int(dttxt[0:4]), int(dttxt[4:6]), int(dttxt[6:8]))
         dtnum = date2num(datetime.combine(dt, self.p.sessionend))
         #dtnum = date2num(datetime.combine(dt, self.p.sessionend), tz=pytz.timezone('Asia/Tokyo'))
 
         self.lines.datetime[0] = dtnum
-        o = float(self._fetch_value(linetokens, self.OPEN))
-        h = float(self._fetch_value(linetokens, self.HIGH))
-        l = float(self._fetch_value(linetokens, self.LOW))
-        rawc = float(self._fetch_value(linetokens, self.CLOSE))
+        o = float(o)
+        h = float(h)
+        l = float(l)
+        rawc = float(rawc)
         self.lines.openinterest[0] = 0.0
 
-        adjustedclose = float(self._fetch_value(linetokens, self.ADJUSTED_CLOSE))
-        v = float(self._fetch_value(linetokens, self.VOLUME))
+        adjustedclose = float(adjustedclose)
+        v = float(v)
 
         if self.p.swapcloses:  # swap closing prices if requested
             rawc, adjustedclose = adjustedclose, rawc
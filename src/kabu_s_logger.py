@@ -44,6 +44,10 @@ class KabuSLogger:
     def warn(self, msg, **kwargs):
         self.log(WARN, msg, **kwargs)
         
+    def isEnabledFor(self, level) -> bool:
+        ''' level のログが出力されるならTrue。重いメッセージを作る前に確認する '''
+        return self._logger.isEnabledFor(level)
+
     def log(self, level, msg, **kwargs):
         if kwargs:
             self._logger.log(level, msg, **kwargs)
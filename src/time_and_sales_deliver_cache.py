@@ -0,0 +1,119 @@
+import os
+from typing import NewType
+
+import numpy as np
+
+from time_and_sales_deliver_feed import HistArrays
+
+EpochNs = NewType('EpochNs', int)
+Segment = NewType('Segment', tuple[EpochNs, EpochNs, str])  # [from, to, path]
+
+class TimeAndSalesDeliverCache(object):
+    '''
+    TimeAndSalesDeliverStore で取得した歩み値を、銘柄コード・期間ごとにローカルへ保存する。
+
+    銘柄コード毎のディレクトリに、期間 [from, to] (両端含む、UTCのエポックナノ秒) を
+    ファイル名にした .npy (構造化配列) を置く。
+    重なる・隣接する期間を保存すると1ファイルにまとめるので、
+    キャッシュ済みの期間の部分区間は常に1ファイルから mmap で切り出せる。
+    '''
+    DTYPE: np.dtype = np.dtype([('datetime', '<i8'), ('price', '<f8'), ('volume', '<f8')])
+    SUFFIX: str = '.npy'
+    STEP: EpochNs = 10 ** 9  # 歩み値の時刻は秒単位なので、期間の境界も秒刻みで扱う
+
+    def __init__(self, cache_dir: str='./tick_cache'):
+        self.cache_dir = cache_dir
+
+    def missing_ranges(self, stock_code: str,
+            from_ns: EpochNs, to_ns: EpochNs) -> list[tuple[EpochNs, EpochNs]]:
+        '''
+        [from_ns, to_ns] のうち、まだキャッシュされていない期間を昇順で返す。
+        '''
+        missing = []
+        cursor = from_ns
+        for seg_from, seg_to, _ in self._segments(stock_code):
+            if seg_to < cursor:
+                continue
+            if seg_from > to_ns:
+                break
+            if seg_from > cursor:
+                missing.append((cursor, seg_from - self.STEP))
+            cursor = max(cursor, seg_to + self.STEP)
+        if cursor <= to_ns:
+            missing.append((cursor, to_ns))
+        return missing
+
+    def load(self, stock_code: str, from_ns: EpochNs, to_ns: EpochNs) -> HistArrays:
+        '''
+        [from_ns, to_ns] を含むキャッシュから、その期間の歩み値を切り出して返す。
+        全体がキャッシュされていなければ None を返す。
+        '''
+        for seg_from, seg_to, path in self._segments(stock_code):
+            if seg_from <= from_ns and to_ns <= seg_to:
+                ticks = np.load(path, mmap_mode='r')
+                head = np.searchsorted(ticks['datetime'], from_ns, side='left')
+                tail = np.searchsorted(ticks['datetime'], to_ns, side='right')
+                return self._to_hist_arrays(ticks[head:tail])
+        return None
+
+    def put(self, stock_code: str, from_ns: EpochNs, to_ns: EpochNs,
+            hist_arrays: HistArrays):
+        '''
+        [from_ns, to_ns] の歩み値を保存する。
+        重なる・隣接するキャッシュとは1ファイルにまとめ、重なる期間は新しい値で置き換える。
+        '''
+        ticks = self._to_ticks(hist_arrays)
+        merged_from, merged_to = from_ns, to_ns
+        parts = [ticks]
+        overlapped = [seg for seg in self._segments(stock_code)
+            if seg[0] <= to_ns + self.STEP and from_ns - self.STEP <= seg[1]]
+        for seg_from, seg_to, path in overlapped:
+            old = np.load(path)
+            outside = (old['datetime'] < from_ns) | (to_ns < old['datetime'])
+            parts.append(old[outside])
+            merged_from, merged_to = min(merged_from, seg_from), max(merged_to, seg_to)
+        merged = np.concatenate(parts)
+        merged = merged[np.argsort(merged['datetime'], kind='stable')]
+
+        os.makedirs(self._code_dir(stock_code), exist_ok=True)
+        path = self._segment_path(stock_code, merged_from, merged_to)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.save(f, merged)
+        os.replace(tmp_path, path)
+        for _, _, old_path in overlapped:
+            if old_path != path:
+                os.remove(old_path)
+
+    def _segments(self, stock_code: str) -> list[Segment]:
+        code_dir = self._code_dir(stock_code)
+        if not os.path.isdir(code_dir):
+            return []
+        segments = []
+        for name in os.listdir(code_dir):
+            if not name.endswith(self.SUFFIX):
+                continue
+            seg_from, seg_to = name[:-len(self.SUFFIX)].split('_')
+            segments.append(Segment((int(seg_from), int(seg_to), os.path.join(code_dir, name))))
+        return sorted(segments)
+
+    def _code_dir(self, stock_code: str) -> str:
+        return os.path.join(self.cache_dir, str(stock_code))
+
+    def _segment_path(self, stock_code: str, from_ns: EpochNs, to_ns: EpochNs) -> str:
+        return os.path.join(self._code_dir(stock_code), f'{from_ns}_{to_ns}{self.SUFFIX}')
+
+    def _to_ticks(self, hist_arrays: HistArrays) -> np.ndarray:
+        timestamps, prices, volumes = hist_arrays
+        ticks = np.empty(len(timestamps), dtype=self.DTYPE)
+        ticks['datetime'] = timestamps
+        ticks['price'] = prices
+        ticks['volume'] = volumes
+        return ticks
+
+    def _to_hist_arrays(self, ticks: np.ndarray) -> HistArrays:
+        return HistArrays((
+            np.ascontiguousarray(ticks['datetime']),
+            np.ascontiguousarray(ticks['price']),
+            np.ascontiguousarray(ticks['volume']),
+        ))
@@ -25,9 +25,12 @@
 # SOFTWARE.
 
 from operator import index
-from typing import NewType, TypeAlias, Dict
+from typing import Iterator, NewType, TypeAlias, Dict
 from collections import deque
+import queue
+import threading
 
+import numpy as np
 import pandas as pd
 from datetime import datetime, date
 import pytz
@@ -38,21 +41,41 @@ from backtrader.utils import date2num
 
 State: TypeAlias = int
 HistData: NewType = NewType('HistData', list[list[datetime, float]])
+HistArrays: NewType = NewType('HistArrays', tuple[np.ndarray, np.ndarray, np.ndarray])  # [epoch ns(int64), price, volume]
 AlreadyCaluculatedPositions: NewType = NewType('AlreadyCaluculatedPositions', set)
 
+NS_PER_DAY: int = 24 * 60 * 60 * 10 ** 9
+EPOCH_ORDINAL: int = date(1970, 1, 1).toordinal()  # date2num での 1970-01-01 00:00:00 UTC
+
+def epoch_ns_to_num(timestamps: np.ndarray) -> np.ndarray:
+    '''
+    エポックナノ秒(int64, UTC)の配列を、date2num と同じ float64 の日時表現に一括で変換する。
+    '''
+    days, remainder = np.divmod(np.asarray(timestamps, dtype=np.int64), NS_PER_DAY)
+    return (days + EPOCH_ORDINAL).astype(np.float64) + remainder / NS_PER_DAY
+
 class TimeAndSalesDeliverData(DataBase):
     params = (
         ('drop_newest', True),
         ('timeframe', TimeFrame.Ticks),
         ('tz', pytz.timezone('Asia/Tokyo')),
+        ('array_backed', True),  # hist_arrays が与えられたら、配列のカーソルを進めるだけで _load する
     )
     _ST_LIVE: State = 0
     _ST_HISTORBACK: State = 1
     _ST_OVER: State = 2
+    _END_OF_CHUNKS = object()  # hist_arrays_iter を読み終えたことを示す番兵
 
-    def __init__(self, start_date=None, data: HistData=None):
+    def __init__(self, start_date=None, data: HistData=None, hist_arrays: HistArrays=None,
+            hist_arrays_iter: Iterator[HistArrays]=None):
         self.start_date = start_date
         self._data = deque()
+        self._hist_data: HistData = None
+        self._hist_arrays: HistArrays = hist_arrays
+        # 与えられたら、別スレッドで読み進めながら、届いたチャンクから順に _load する
+        self._hist_arrays_iter: Iterator[HistArrays] = hist_arrays_iter
+        self._chunks: queue.Queue = None
+        self._cursor: int = None  # array_backed 時に次に読む位置
         if data:
             self._hist_data = data
         self._interest_last_caluculated_date: date = date(1900, 1, 1)  # 金利を最後に計算した日付
@@ -80,14 +103,77 @@ class TimeAndSalesDeliverData(DataBase):
             self._state = self._ST_HISTORBACK
             self.put_notification(self.DELAYED)
 
-            df = pd.DataFrame(self._hist_data,
-                    columns=['datetime', 'price', 'volume'])
+            if self._hist_arrays_iter is not None:
+                self._start_lazy(self._hist_arrays_iter)
+                return
+            if self._hist_arrays is not None and self.p.array_backed:
+                self._start_array_backed(self._hist_arrays)
+                return
+            if self._hist_arrays is not None:
+                df = self._hist_arrays_to_df(self._hist_arrays)
+            else:
+                df = pd.DataFrame(self._hist_data,
+                        columns=['datetime', 'price', 'volume'])
             df.index = df.datetime
             self._data.extend(df.values.tolist())            
         else:
             self._start_live()
 
+    def _start_array_backed(self, hist_arrays: HistArrays):
+        ''' 日時を date2num 済みの float64 に変換しておき、_load ではカーソルを進めるだけにする '''
+        timestamps, prices, volumes = hist_arrays
+        self._datetimes = epoch_ns_to_num(timestamps)
+        self._prices = np.asarray(prices, dtype=np.float64)
+        self._volumes = np.asarray(volumes, dtype=np.float64)
+        self._cursor = 0
+
+    def _start_lazy(self, hist_arrays_iter: Iterator[HistArrays]):
+        '''
+        hist_arrays_iter をプロデューサースレッドで読み進め、キューに積む。
+        _load は最初のチャンクが届いた時点で始められるので、残りのダウンロードと
+        (cerebro.run(preload=False) なら) ストラテジーの計算とが重なる。
+        '''
+        self._start_array_backed(HistArrays((
+            np.empty(0, dtype=np.int64), np.empty(0), np.empty(0))))
+        self._chunks = queue.Queue()
+
+        def produce():
+            try:
+                for hist_arrays in hist_arrays_iter:
+                    self._chunks.put(hist_arrays)
+            except BaseException as e:
+                self._chunks.put(e)  # _load 側で投げ直す
+            finally:
+                self._chunks.put(self._END_OF_CHUNKS)
+
+        threading.Thread(target=produce, daemon=True).start()
+
+    def _next_chunk(self) -> bool:
+        ''' 次のチャンクが届くまで待って、カーソルをその先頭に移す。もう無ければFalse '''
+        if self._chunks is None:
+            return False
+        chunk = self._chunks.get()
+        if chunk is self._END_OF_CHUNKS:
+            self._chunks = None
+            return False
+        if isinstance(chunk, BaseException):
+            self._chunks = None
+            raise chunk
+        self._start_array_backed(chunk)
+        return True
+
+    def _hist_arrays_to_df(self, hist_arrays: HistArrays) -> pd.DataFrame:
+        ''' 列ごとのNumPy配列から、_hist_data と同じ形のDFを作る '''
+        timestamps, prices, volumes = hist_arrays
+        return pd.DataFrame({
+            'datetime': pd.to_datetime(timestamps, unit='ns', utc=True),
+            'price': prices,
+            'volume': volumes,
+        })
+
     def _load(self):
+        if self._cursor is not None:
+            return self._load_from_arrays()
         try:
             line = self._data.popleft()
         except IndexError:
@@ -104,6 +190,22 @@ class TimeAndSalesDeliverData(DataBase):
         self.lines.volume[0] = volume
         return True
 
+    def _load_from_arrays(self):
+        i = self._cursor
+        while i >= len(self._datetimes):
+            if not self._next_chunk():
+                return None
+            i = self._cursor
+        self._cursor = i + 1
+        price = self._prices[i]
+        self.lines.datetime[0] = self._datetimes[i]
+        self.lines.open[0] = price
+        self.lines.high[0] = price
+        self.lines.low[0] = price
+        self.lines.close[0] = price
+        self.lines.volume[0] = self._volumes[i]
+        return True
+
 
 
 class BinanceData(DataBase):
@@ -24,7 +24,7 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-from typing import NewType
+from typing import Iterator, NewType
 
 import time
 
@@ -38,28 +38,120 @@ from requests.exceptions import ConnectTimeout, ConnectionError
 # from .binance_broker import BinanceBroker
 # from .binance_feed import BinanceData
 import sys, os
-from datetime import date, datetime
+import codecs
+import io
+import re
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta, timezone
+import pytz
 import urllib3
 import json
+import numpy as np
 import pandas as pd
 
 sys.path.append(os.path.join(os.path.dirname(__file__), '.'))
 from time_and_sales_deliver_broker import TimeAndSalesDeliverBroker, TimeAndSaledDeliverEnum
 from time_and_sales_deliver_feed import TimeAndSalesDeliverData
+from time_and_sales_deliver_cache import TimeAndSalesDeliverCache
+from adj_factors import AdjFactors
 
 RawHistData = NewType('HistData', list[list[str, str, str]])
 HistData = NewType('HistData', list[list[datetime, float, float]]) # [datetime, price, volume]
+HistArrays = NewType('HistArrays', tuple[np.ndarray, np.ndarray, np.ndarray]) # [epoch ns(int64), price, volume]
 Positions = NewType('Positions', list[datetime, Position])
 
+class TimeAndSalesDeliverHTTPError(Exception):
+    '''
+    歩み値サーバが 200 以外を返した。
+    5xx と 429 は一時的なものとしてリトライする。
+    '''
+    def __init__(self, status: int, url: str):
+        super().__init__(f'HTTP {status}: {url}')
+        self.status = status
+        self.url = url
+
+    @property
+    def retryable(self) -> bool:
+        return self.status >= 500 or self.status == 429
+
 class TimeAndSalesDeliverStore(object):
-    def __init__(self, host: str, port: int=80, protocol='http', retries=5):
+    TIMESTAMP_FORMAT: str = '%Y-%m-%d %H:%M:%S %z'
+    TZ = pytz.timezone('Asia/Tokyo')  # タイムゾーンのない日時はJSTとみなす
+    EPOCH: datetime = datetime(1970, 1, 1, tzinfo=timezone.utc)
+    STREAM_CHUNK_SIZE: int = 64 * 1024  # streaming 時にレスポンスを読むバイト数
+    STREAM_BATCH_SIZE: int = 10000  # streaming 時にまとめてパースするtick数
+    _WHITESPACE = re.compile(r'\s*')
+    # TIMESTAMP_FORMAT の各文字の位置 e.g. '2021-11-01 09:00:01 +0900'
+    _TIMESTAMP_LENGTH: int = 25
+    _TIMESTAMP_SEPARATORS: dict[int, bytes] = {4: b'-', 7: b'-', 10: b' ', 13: b':', 16: b':', 19: b' '}
+    _TIMESTAMP_DIGITS: list[int] = [0, 1, 2, 3, 5, 6, 8, 9, 11, 12, 14, 15, 17, 18, 21, 22, 23, 24]
+    _TIMESTAMP_PREFIX: list[int] = [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 20, 21, 22, 23, 24]  # 日付とオフセット
+    _SEPARATOR_POSITIONS: list[int] = list(_TIMESTAMP_SEPARATORS.keys())
+    _SEPARATOR_CODES: np.ndarray = np.array([ord(c) for c in _TIMESTAMP_SEPARATORS.values()], dtype=np.uint32)
+    # 通信が途切れた・タイムアウトした・壊れたJSONが返ってきた場合はリトライする
+    RETRYABLE_ERRORS = (urllib3.exceptions.HTTPError, json.JSONDecodeError,
+        TimeAndSalesDeliverHTTPError)
+    # 歩み値のレスポンス形式。サーバが対応していなければ JSON が返ってくる
+    WIRE_FORMATS: dict[str, str] = {
+        'npy': 'application/x-npy',  # TimeAndSalesDeliverCache.DTYPE の構造化配列を np.save したもの
+        'csv': 'text/csv',  # datetime,volume,price (ヘッダなし)
+        'json': 'application/json',
+    }
+
+    def __init__(self, host: str, port: int=80, protocol='http', retries=5,
+            columnar: bool=True, cache_dir: str=None, max_workers: int=8,
+            streaming: bool=False, lazy: bool=False,
+            connect_timeout: float=5.0, read_timeout: float=30.0,
+            backoff_factor: float=0.5, backoff_max: float=30.0,
+            wire_formats: tuple[str, ...]=('npy', 'csv', 'json'),
+            adj_factors_path: str=None):
         self.host = host
         self.port = port
         self.protocol = protocol
-        self.retries = retries
+        if retries < 1:
+            raise ValueError(f'retries must be >= 1: {retries}')
+        self.retries = retries  # 1期間(1日分)あたりの最大試行回数 (最初の1回を含む)
+        self.backoff_factor = backoff_factor  # n回目の失敗後に backoff_factor * 2 ** (n - 1) 秒待つ
+        self.backoff_max = backoff_max  # 待ち時間の上限(秒)
+        self.wire_formats = wire_formats  # columnar 時に受け取りたい形式 (優先順)
+        self.columnar = columnar  # TrueならNumPy配列のまま TimeAndSalesDeliverData に渡す
+        self.max_workers = max_workers  # 日ごとに分割した期間を、並行に取りに行く数
+        self.streaming = streaming  # Trueならレスポンス全体を読み込まず、少しずつ列指向の配列にする
+        self.lazy = lazy  # Trueならダウンロードの完了を待たず、届いた日から TimeAndSalesDeliverData に流す
         self._broker = TimeAndSalesDeliverBroker(store=self)
-        self._data: HistData = None
-        self._http = urllib3.PoolManager()
+        self._datas: dict[tuple[str, datetime, datetime], TimeAndSalesDeliverData] = {}
+        # 複数銘柄を並行に取りに行っても、ホスト毎の接続数は maxsize までに抑える
+        # リトライは retry で行うので、urllib3 自体にはリトライさせない
+        self._http = urllib3.PoolManager(maxsize=max_workers, block=True, retries=False,
+            timeout=urllib3.Timeout(connect=connect_timeout, read=read_timeout))
+        # 指定すれば、取得した歩み値をローカルにキャッシュし、次回以降は取りに行かない
+        self._cache: TimeAndSalesDeliverCache = \
+            TimeAndSalesDeliverCache(cache_dir) if cache_dir else None
+        # gzip/deflate (urllib3 が対応していれば br/zstd も) で圧縮して送ってもらい、urllib3 に展開させる
+        self._accept_encoding: dict[str, str] = urllib3.util.make_headers(accept_encoding=True)
+        # 指定すれば、取得した歩み値の価格・出来高を、最新の株数基準に調整して渡す
+        self._adj_factors: AdjFactors = \
+            AdjFactors.load(adj_factors_path) if adj_factors_path else None
+        # b'2021-11-01+0900' のような日付とオフセット -> その日の 00:00:00 のエポックナノ秒
+        self._day_base_ns: dict[bytes, int] = {}
+
+    def retry(func):
+        @wraps(func)
+        def wrapper(self, *args, **kwargs):
+            for attempt in range(1, self.retries + 1):
+                try:
+                    return func(self, *args, **kwargs)
+                except self.RETRYABLE_ERRORS as err:
+                    if attempt == self.retries or not self._is_retryable(err):
+                        raise
+                    self._backoff(attempt)
+        return wrapper
+
+    def _is_retryable(self, err: Exception) -> bool:
+        return not isinstance(err, TimeAndSalesDeliverHTTPError) or err.retryable
+
+    def _backoff(self, attempt: int):
+        time.sleep(min(self.backoff_max, self.backoff_factor * 2 ** (attempt - 1)))
 
     def getbroker(self):
         return self._broker
@@ -67,28 +159,392 @@ class TimeAndSalesDeliverStore(object):
     def getdata(self, stock_code: str, \
             start_dt: datetime=None, end_dt: datetime=None) -> TimeAndSalesDeliverData:
         '''
-        FIXME
+        銘柄コード・期間毎に TimeAndSalesDeliverData を作って返す。
+        同じ銘柄コード・期間なら、作成済みのものを返す。
         '''
-        if not self._data:
-            self._data = self.get_historical_data(stock_code, start_dt, end_dt)
-        return self._data
+        key = (str(stock_code), start_dt, end_dt)
+        if key not in self._datas:
+            self._datas[key] = self.get_historical_data(stock_code, start_dt, end_dt)
+        return self._datas[key]
+
+    def getdatas(self, stock_codes: list[str], \
+            start_dt: datetime=None, end_dt: datetime=None) -> list[TimeAndSalesDeliverData]:
+        '''
+        複数銘柄の getdata を、1つの PoolManager を共有して並行に行う。
+        stock_codes と同じ順に返す。
+        '''
+        missing_codes = list(dict.fromkeys(str(code) for code in stock_codes
+            if (str(code), start_dt, end_dt) not in self._datas))
+        fetch = lambda code: self.get_historical_data(code, start_dt, end_dt)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for code, data in zip(missing_codes, executor.map(fetch, missing_codes)):
+                self._datas[(code, start_dt, end_dt)] = data
+        return [self.getdata(code, start_dt, end_dt) for code in stock_codes]
 
     def get_historical_data(self, stock_code: str,
             from_dt: datetime, to_dt: datetime) -> TimeAndSalesDeliverData:
         '''
         http://lvh.me:4567/7974/2022-01-01T12:34:56 のようなフォーマットで取りに行く
         '''
-        url: str = self._endpoint_url_range(stock_code, from_dt, to_dt)
-        resp = self._http.request('GET', url)
-        data: RawHistData = json.loads(resp.data.decode('utf-8'))
-        hist_data: HistData = self._parse_hist_data(data)
+        if self._cache and self._is_settled(to_dt):
+            hist_arrays: HistArrays = self._get_hist_arrays_with_cache(stock_code, from_dt, to_dt)
+            hist_arrays = self._adjust_hist_arrays(stock_code, hist_arrays)
+            return TimeAndSalesDeliverData(start_date=from_dt, hist_arrays=hist_arrays, dataname='TimeAndSalesDeliverData')
+        if self.columnar and self.lazy:
+            return TimeAndSalesDeliverData(start_date=from_dt,
+                hist_arrays_iter=(self._adjust_hist_arrays(stock_code, hist_arrays)
+                    for hist_arrays in self._iter_hist_arrays(stock_code, from_dt, to_dt)),
+                dataname='TimeAndSalesDeliverData')
+        if self.columnar:
+            hist_arrays: HistArrays = self._fetch_hist_arrays(stock_code, from_dt, to_dt)
+            hist_arrays = self._adjust_hist_arrays(stock_code, hist_arrays)
+            return TimeAndSalesDeliverData(start_date=from_dt, hist_arrays=hist_arrays, dataname='TimeAndSalesDeliverData')
+        hist_data: HistData = [tick
+            for data in self._iter_raw_hist_data(stock_code, from_dt, to_dt)
+            for tick in self._parse_hist_data(data)]
+        hist_data = self._adjust_hist_data(stock_code, hist_data)
         return TimeAndSalesDeliverData(start_date=from_dt, data=hist_data, dataname='TimeAndSalesDeliverData')
 
+    def _adjust_hist_arrays(self, stock_code: str, hist_arrays: HistArrays) -> HistArrays:
+        '''
+        adj_factors_path を与えていれば、価格・出来高を最新の株数基準に調整する。
+        基準は調整係数に載っている最新の併合・分割で、取得した期間の最後ではない
+        (期間の最後の行を基準にする KabuPlusJPCSVData とは異なる)。
+        キャッシュ (mmap) の配列は書き換えず、新しい配列を返す。
+        '''
+        if self._adj_factors is None:
+            return hist_arrays
+        timestamps, prices, volumes = hist_arrays
+        prices, volumes = self._adj_factors.adjust(stock_code, timestamps, prices, volumes)
+        return HistArrays((timestamps, prices, volumes))
+
+    def _adjust_hist_data(self, stock_code: str, hist_data: HistData) -> HistData:
+        ''' _adjust_hist_arrays の、columnar=False 用 '''
+        if self._adj_factors is None or not hist_data:
+            return hist_data
+        timestamps = pd.DatetimeIndex(pd.to_datetime([tick[0] for tick in hist_data], utc=True)).asi8
+        factors = self._adj_factors.factor(stock_code, timestamps)
+        return HistData([[dt, price * factor, volume / factor]
+            for (dt, price, volume), factor in zip(hist_data, factors)])
+
+    @retry
+    def _fetch_raw_hist_data(self, stock_code: str,
+            from_dt: datetime, to_dt: datetime) -> RawHistData:
+        url: str = self._endpoint_url_range(stock_code, from_dt, to_dt)
+        resp = self._http.request('GET', url, headers=self._headers(('json',)))
+        self._raise_for_status(resp, url)
+        return json.loads(resp.data.decode('utf-8'))
+
+    @retry
+    def _fetch_hist_arrays_negotiated(self, stock_code: str,
+            from_dt: datetime, to_dt: datetime) -> HistArrays:
+        '''
+        wire_formats の優先順でレスポンス形式を指定して取りに行き、
+        返ってきた Content-Type に応じてパースする。
+        '''
+        url: str = self._endpoint_url_range(stock_code, from_dt, to_dt)
+        resp = self._http.request('GET', url, headers=self._headers(self.wire_formats))
+        self._raise_for_status(resp, url)
+        content_type: str = resp.headers.get('Content-Type', '').split(';')[0].strip()
+        if content_type == self.WIRE_FORMATS['npy']:
+            return self._parse_hist_data_npy(resp.data)
+        if content_type == self.WIRE_FORMATS['csv']:
+            return self._parse_hist_data_csv(resp.data)
+        return self._parse_hist_data_columnar(json.loads(resp.data.decode('utf-8')))
+
+    def _headers(self, wire_formats: tuple[str, ...]) -> dict[str, str]:
+        # e.g. application/x-npy, text/csv;q=0.9, application/json;q=0.8
+        accept = ', '.join(self.WIRE_FORMATS[wire_format] + (f';q={1.0 - i / 10:.1f}' if i else '')
+            for i, wire_format in enumerate(wire_formats))
+        return {**self._accept_encoding, 'Accept': accept}
+
+    def _raise_for_status(self, resp, url: str):
+        if resp.status != 200:
+            raise TimeAndSalesDeliverHTTPError(resp.status, url)
+
+    def _iter_raw_hist_data(self, stock_code: str,
+            from_dt: datetime, to_dt: datetime) -> Iterator[RawHistData]:
+        '''
+        期間を日ごとに分割して並行に取りに行き、古い日から順に返す。
+        '''
+        fetch = lambda chunk: self._fetch_raw_hist_data(stock_code, *chunk)
+        yield from self._map_chunks(fetch, self._split_range_by_day(from_dt, to_dt))
+
+    def _iter_hist_arrays(self, stock_code: str,
+            from_dt: datetime, to_dt: datetime) -> Iterator[HistArrays]:
+        '''
+        _iter_raw_hist_data の列指向版。パースも日ごとに並行して行う。
+        '''
+        fetch = lambda chunk: self._fetch_chunk_hist_arrays(stock_code, *chunk)
+        yield from self._map_chunks(fetch, self._split_range_by_day(from_dt, to_dt))
+
+    def _fetch_hist_arrays(self, stock_code: str,
+            from_dt: datetime, to_dt: datetime) -> HistArrays:
+        return self._concat_hist_arrays(
+            list(self._iter_hist_arrays(stock_code, from_dt, to_dt)))
+
+    def _fetch_chunk_hist_arrays(self, stock_code: str,
+            from_dt: datetime, to_dt: datetime) -> HistArrays:
+        if self.streaming:
+            return self._fetch_hist_arrays_streaming(stock_code, from_dt, to_dt)
+        return self._fetch_hist_arrays_negotiated(stock_code, from_dt, to_dt)
+
+    def _fetch_hist_arrays_streaming(self, stock_code: str,
+            from_dt: datetime, to_dt: datetime) -> HistArrays:
+        '''
+        _stream_hist_arrays を、途中で失敗したら受信済みの続きから取り直しながら最後まで読む。
+        '''
+        batches: list[HistArrays] = []
+        resume_dt = from_dt
+        for attempt in range(1, self.retries + 1):
+            try:
+                for batch in self._stream_hist_arrays(stock_code, resume_dt, to_dt):
+                    batches.append(batch)
+                break
+            except self.RETRYABLE_ERRORS as err:
+                if attempt == self.retries or not self._is_retryable(err):
+                    raise
+                received = self._concat_hist_arrays(batches)
+                if len(received[0]):
+                    # 最後に受け取った秒のtickは途中までかもしれないので、その秒から取り直す
+                    last_ns = received[0][-1]
+                    batches = [self._slice_hist_arrays(received, received[0] < last_ns)]
+                    resume_dt = self._from_epoch_ns(int(last_ns))
+                self._backoff(attempt)
+        return self._concat_hist_arrays(batches)
+
+    def _slice_hist_arrays(self, hist_arrays: HistArrays, mask: np.ndarray) -> HistArrays:
+        return HistArrays(tuple(column[mask] for column in hist_arrays))
+
+    def _stream_hist_arrays(self, stock_code: str,
+            from_dt: datetime, to_dt: datetime) -> Iterator[HistArrays]:
+        '''
+        レスポンスを STREAM_CHUNK_SIZE ずつ読みながらデコードし、
+        STREAM_BATCH_SIZE tick毎に列指向の配列にして返す。
+        生のレスポンス全体やその文字列、list of lists を同時に持たないので、
+        期間が長くてもメモリ使用量は配列の分だけで済む。
+        '''
+        url: str = self._endpoint_url_range(stock_code, from_dt, to_dt)
+        resp = self._http.request('GET', url, headers=self._headers(('json',)),
+            preload_content=False)
+        try:
+            self._raise_for_status(resp, url)
+            batch: RawHistData = []
+            for tick in self._iter_json_array_items(resp.stream(self.STREAM_CHUNK_SIZE)):
+                batch.append(tick)
+                if len(batch) >= self.STREAM_BATCH_SIZE:
+                    yield self._parse_hist_data_columnar(batch)
+                    batch = []
+            if batch:
+                yield self._parse_hist_data_columnar(batch)
+        except BaseException:
+            resp.close()  # 読みかけの接続をプールに戻さない
+            raise
+        finally:
+            resp.release_conn()
+
+    def _iter_json_array_items(self, chunks: Iterator[bytes]) -> Iterator:
+        '''
+        バイト列で少しずつ届く JSON の配列 [item, item, ...] を、1要素ずつデコードして返す。
+        要素は歩み値のような配列を想定しており、途中で切れた要素は次のチャンクを待ってデコードする。
+        '''
+        decoder = json.JSONDecoder()
+        text_decoder = codecs.getincrementaldecoder('utf-8')()
+        buf, pos = '', 0
+        started = False
+        for chunk in chunks:
+            buf = buf[pos:] + text_decoder.decode(chunk)
+            pos = 0
+            while True:
+                pos = self._WHITESPACE.match(buf, pos).end()
+                if pos >= len(buf):
+                    break
+                if not started:
+                    if buf[pos] != '[':
+                        raise ValueError(f'JSON array expected: {buf[pos:pos + 32]!r}')
+                    started = True
+                    pos += 1
+                elif buf[pos] == ',':
+                    pos += 1
+                elif buf[pos] == ']':
+                    return
+                else:
+                    try:
+                        item, pos = decoder.raw_decode(buf, pos)
+                    except json.JSONDecodeError:
+                        break  # 要素の途中でチャンクが切れている
+                    yield item
+        raise json.JSONDecodeError('JSON array is truncated', buf, len(buf))
+
+    def _concat_hist_arrays(self, chunks: list[HistArrays]) -> HistArrays:
+        if not chunks:
+            return self._parse_hist_data_columnar([])
+        return HistArrays(tuple(np.concatenate(column) for column in zip(*chunks)))
+
+    def _map_chunks(self, fetch, chunks: list[tuple[datetime, datetime]]) -> Iterator:
+        if len(chunks) <= 1 or self.max_workers <= 1:
+            yield from map(fetch, chunks)
+            return
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            yield from executor.map(fetch, chunks)  # 完了順ではなく、chunks の順に返る
+
+    def _split_range_by_day(self, from_dt: datetime,
+            to_dt: datetime) -> list[tuple[datetime, datetime]]:
+        '''
+        [from_dt, to_dt] を、日付の変わり目で重ならないように分割する。
+        e.g. 11/01 09:00:00 - 11/02 15:00:00
+            -> [(11/01 09:00:00, 11/01 23:59:59), (11/02 00:00:00, 11/02 15:00:00)]
+        '''
+        chunks = []
+        chunk_from = from_dt
+        while chunk_from <= to_dt:
+            next_day = (chunk_from + timedelta(days=1)) \
+                .replace(hour=0, minute=0, second=0, microsecond=0)
+            chunks.append((chunk_from, min(next_day - timedelta(seconds=1), to_dt)))
+            chunk_from = next_day
+        return chunks
+
+    def _get_hist_arrays_with_cache(self, stock_code: str,
+            from_dt: datetime, to_dt: datetime) -> HistArrays:
+        '''
+        キャッシュにない期間だけを取りに行って保存し、キャッシュから期間全体を返す。
+        '''
+        from_ns, to_ns = self._to_epoch_ns(from_dt), self._to_epoch_ns(to_dt)
+        for missing_from, missing_to in self._cache.missing_ranges(stock_code, from_ns, to_ns):
+            self._cache.put(stock_code, missing_from, missing_to, self._fetch_hist_arrays(stock_code,
+                self._from_epoch_ns(missing_from), self._from_epoch_ns(missing_to)))
+        return self._cache.load(stock_code, from_ns, to_ns)
+
+    def _is_settled(self, to_dt: datetime) -> bool:
+        ''' 期間の終わりが過去なら、歩み値は確定しているのでキャッシュしてよい '''
+        return self._to_epoch_ns(to_dt) < self._to_epoch_ns(datetime.now(timezone.utc))
+
+    def _to_epoch_ns(self, dt: datetime) -> int:
+        if dt.tzinfo is None:
+            dt = self.TZ.localize(dt)
+        return (dt - self.EPOCH) // timedelta(microseconds=1) * 1000
+
+    def _from_epoch_ns(self, epoch_ns: int) -> datetime:
+        ''' _to_epoch_ns の逆変換。URLに埋め込むため、タイムゾーンなしのJSTで返す '''
+        dt = self.EPOCH + timedelta(microseconds=epoch_ns // 1000)
+        return dt.astimezone(self.TZ).replace(tzinfo=None)
+
     def _parse_hist_data(self, hist_data: RawHistData) -> HistData:
         # [datetime, price, volume]
-        parser = lambda x: [datetime.strptime(x[0], '%Y-%m-%d %H:%M:%S %z'), float(x[2]), float(x[1])]
+        parser = lambda x: [datetime.strptime(x[0], self.TIMESTAMP_FORMAT), float(x[2]), float(x[1])]
         return list(map(parser, hist_data))
 
+    def _parse_hist_data_columnar(self, hist_data: RawHistData) -> HistArrays:
+        '''
+        _parse_hist_data のベクトル化版。
+        1tickずつ strptime せず、列ごとにまとめてパースする。
+
+        Returns
+        ---------------------
+        (timestamps, prices, volumes): HistArrays
+            timestamps はUTCのエポックナノ秒(int64)、prices, volumes は float64
+        '''
+        # [datetime, volume, price] の組を列毎に取り出す。
+        # list of lists を丸ごと np.array(dtype=str) にして astype するより、列毎に float する方が速い
+        n = len(hist_data)
+        timestamps = self._parse_timestamps(np.array([tick[0] for tick in hist_data], dtype=str))
+        prices = np.fromiter(map(float, [tick[2] for tick in hist_data]), dtype=np.float64, count=n)
+        volumes = np.fromiter(map(float, [tick[1] for tick in hist_data]), dtype=np.float64, count=n)
+        return HistArrays((timestamps, prices, volumes))
+
+    def _parse_hist_data_csv(self, body: bytes) -> HistArrays:
+        ''' text/csv のレスポンス (datetime,volume,price) をパースする '''
+        if not body.strip():
+            return self._parse_hist_data_columnar([])  # tickが無い日は空で返ってくる
+        df = pd.read_csv(io.BytesIO(body), header=None, names=['datetime', 'volume', 'price'],
+            dtype={'datetime': str, 'volume': np.float64, 'price': np.float64})
+        return HistArrays((self._parse_timestamps(df['datetime'].to_numpy(dtype=str)),
+            df['price'].to_numpy(), df['volume'].to_numpy()))
+
+    def _parse_hist_data_npy(self, body: bytes) -> HistArrays:
+        ''' application/x-npy のレスポンスは、キャッシュと同じ構造化配列 '''
+        ticks = np.load(io.BytesIO(body), allow_pickle=False)
+        return HistArrays((ticks['datetime'].astype(np.int64),
+            ticks['price'].astype(np.float64), ticks['volume'].astype(np.float64)))
+
+    def _parse_timestamps(self, timestamps: np.ndarray) -> np.ndarray:
+        '''
+        TIMESTAMP_FORMAT の文字列の配列を、UTCのエポックナノ秒(int64)の配列にする。
+
+        同じ日のtickは日付とオフセット (e.g. '2021-11-01', '+0900') が同じなので、
+        その部分は日毎に1回だけ strptime してキャッシュし、各tickは固定位置の数字から
+        その日の経過秒だけを計算する。形式が違うものが混ざっていれば、
+        _parse_hist_data と同じく1つずつ strptime する (不正な日時なら ValueError)。
+        '''
+        timestamps = np.asarray(timestamps)
+        if len(timestamps) == 0:
+            return np.empty(0, dtype=np.int64)
+        chars = self._timestamp_chars(timestamps)
+        if chars is None:
+            return self._parse_timestamps_strptime(timestamps)
+
+        # 文字コード - '0' を uint32 のまま計算するので、数字以外は 9 より大きくなる
+        digits = chars[:, self._TIMESTAMP_DIGITS] - ord('0')
+        if np.any(digits > 9):
+            return self._parse_timestamps_strptime(timestamps)
+        digits = digits.astype(np.int64)
+        hours = digits[:, 8] * 10 + digits[:, 9]
+        minutes = digits[:, 10] * 10 + digits[:, 11]
+        seconds = digits[:, 12] * 10 + digits[:, 13]
+        if np.any((hours > 23) | (minutes > 59) | (seconds > 59)):
+            return self._parse_timestamps_strptime(timestamps)  # strptime と同じく ValueError にする
+        seconds_of_day = hours * 3600 + minutes * 60 + seconds
+
+        # 日付とオフセットが変わる位置で区切り、区間毎にその日の 00:00:00 を引く
+        # e.g. '2021-11-01 ... +0900' -> 20211101 * 10 ** 5 + 1 * 10 ** 4 + 900
+        day_keys = digits[:, 0:8] @ (10 ** np.arange(12, 4, -1, dtype=np.int64)) \
+            + (chars[:, 20] == ord('+')) * 10 ** 4 \
+            + digits[:, 14:18] @ (10 ** np.arange(3, -1, -1, dtype=np.int64))
+        starts = np.flatnonzero(np.r_[True, day_keys[1:] != day_keys[:-1]])
+        day_base_ns = np.array([
+            self._day_base(chars[i, self._TIMESTAMP_PREFIX].astype(np.uint8).tobytes())
+            for i in starts], dtype=np.int64)
+        lengths = np.diff(np.r_[starts, len(chars)])
+        return np.repeat(day_base_ns, lengths) + seconds_of_day * 10 ** 9
+
+    def _parse_timestamps_strptime(self, timestamps: np.ndarray) -> np.ndarray:
+        '''
+        _parse_timestamps のフォールバック。
+        pd.to_datetime(format=TIMESTAMP_FORMAT) は %z があると1tickずつの strptime より遅いので使わない。
+        '''
+        return np.fromiter(
+            ((datetime.strptime(str(timestamp), self.TIMESTAMP_FORMAT) - self.EPOCH)
+                // timedelta(microseconds=1) * 1000 for timestamp in timestamps),
+            dtype=np.int64, count=len(timestamps))
+
+    def _timestamp_chars(self, timestamps: np.ndarray) -> np.ndarray:
+        '''
+        文字列の配列を、コピーせずに (n, 25) の文字コードの配列として見る。
+        区切り文字とオフセットの符号の位置が TIMESTAMP_FORMAT と違えば None を返す。
+        25文字より短いものは NUL で埋まっているので、ここか数字の検査で弾かれる。
+        '''
+        length = self._TIMESTAMP_LENGTH
+        if timestamps.dtype.kind == 'O':
+            timestamps = timestamps.astype(str)
+        if timestamps.dtype == np.dtype(f'<U{length}'):
+            chars = np.ascontiguousarray(timestamps).view(np.uint32).reshape(-1, length)
+        elif timestamps.dtype == np.dtype(f'S{length}'):
+            chars = np.ascontiguousarray(timestamps).view(np.uint8).reshape(-1, length)
+        else:
+            return None
+        if np.any(chars[:, self._SEPARATOR_POSITIONS] != self._SEPARATOR_CODES):
+            return None
+        if np.any((chars[:, 20] != ord('+')) & (chars[:, 20] != ord('-'))):
+            return None
+        return chars
+
+    def _day_base(self, prefix: bytes) -> int:
+        ''' b'2021-11-01+0900' -> 2021-11-01 00:00:00 +0900 のエポックナノ秒 '''
+        if prefix not in self._day_base_ns:
+            dt = datetime.strptime(prefix.decode('ascii'), '%Y-%m-%d%z')
+            self._day_base_ns[prefix] = (dt - self.EPOCH) // timedelta(microseconds=1) * 1000
+        return self._day_base_ns[prefix]
+
 
     def _endpoint_url_range(self, stock_code: str, from_dt: datetime, to_dt: datetime) -> str:
         from_str = from_dt.strftime('%Y-%m-%dT%H:%M:%S')